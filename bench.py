@@ -0,0 +1,210 @@
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import importlib
+import numpy as np
+
+import torch as T
+import torch.optim as optim
+
+from lib import common
+from lib.rollout import RolloutBuffer
+import train
+from train import AtariA2C, unpack_buffer, train_step
+from sub_envs.map import MakeMap
+from sub_envs.vector import VectorMEDAEnv
+import ptan
+
+# Every benchmark reports a throughput or a latency under a fixed seed and a
+# fixed amount of work; the median over --repeat runs is kept.
+
+MAP_CONFIGS = [(8, 8, 1, 0.9), (8, 8, 2, 0.8), (16, 16, 2, 0.8), (32, 32, 2, 0.9)]
+ENV_MODULES = ["envs.static", "envs.dynamic", "sub_envs.static", "sub_envs.dynamic"]
+OBS_SIZES = [8, 16, 32, 64]
+BATCH_SIZES = [1, 16, 64, 256]
+
+def _timed(func, n):
+	# Warm up caches, allocators and lazy initialization first
+	func(max(1, n//10))
+	ts = time.perf_counter()
+	func(n)
+	return time.perf_counter() - ts
+
+def bench_map_gen(quick):
+	results = {}
+	for w, h, dsize, p in MAP_CONFIGS:
+		np.random.seed(0)
+		mapclass = MakeMap(w=w, h=h, dsize=dsize, p=p)
+		n = 50 if quick else 500
+		seconds = _timed(lambda n: [mapclass.gen_random_map() for _ in range(n)], n)
+		results["map_gen/%dx%d_d%d_p%.2f" % (w, h, dsize, p)] = (n / seconds, "maps/s", True)
+	return results
+
+def bench_env_step(quick):
+	results = {}
+	for name in ENV_MODULES:
+		module = importlib.import_module(name)
+		np.random.seed(0)
+		if name.startswith("envs"):
+			env = module.MEDAEnv(w=8, h=8, p=0.9)
+		else:
+			env = module.MEDAEnv(w=8, h=8, dsize=2, p=0.8)
+		actions = np.random.RandomState(0).randint(4, size=2000 if quick else 20000)
+
+		def run(n):
+			env.reset()
+			for action in actions[:n]:
+				_, _, done, _ = env.step(action)
+				if done:
+					env.reset()
+		seconds = _timed(run, len(actions))
+		results["env_step/%s" % name] = (len(actions) / seconds, "steps/s", True)
+	return results
+
+def bench_get_obs(quick):
+	module = importlib.import_module("sub_envs.static")
+	results = {}
+	for size in OBS_SIZES:
+		np.random.seed(0)
+		env = module.MEDAEnv(w=size, h=size, dsize=2, p=0.9)
+		n = 2000 if quick else 20000
+		seconds = _timed(lambda n: [env._get_obs() for _ in range(n)], n)
+		results["get_obs/%dx%d" % (size, size)] = (1e6 * seconds / n, "us/call", False)
+	return results
+
+def bench_net(quick):
+	results = {}
+	T.manual_seed(0)
+	net = AtariA2C((8, 8, 3), 4)
+	n = 20 if quick else 200
+	for batch in BATCH_SIZES:
+		x = T.rand(batch, 8, 8, 3)
+		with T.no_grad():
+			net(x)
+			seconds = _timed(lambda n: [net(x) for _ in range(n)], n)
+		results["net_forward/b%d" % batch] = (1000 * seconds / n, "ms/batch", False)
+
+		def step(n):
+			for _ in range(n):
+				net.zero_grad()
+				logits_v, value_v = net(x)
+				(logits_v.sum() + value_v.sum()).backward()
+		seconds = _timed(step, n)
+		results["net_forward_backward/b%d" % batch] = (1000 * seconds / n, "ms/batch", False)
+	return results
+
+def bench_train(quick):
+	"""
+	Samples/s of the train.py A2C loop (vector env, buffer, train_step, Adam)
+	at its settings, with the default two-pass backward and --fused-backward
+	"""
+	results = {}
+	for n_envs, fused in ((1, False), (16, False), (16, True)):
+		np.random.seed(0)
+		T.manual_seed(0)
+		env = VectorMEDAEnv(n_envs=n_envs, w=train.W, h=train.H, dsize=train.DSIZE, p=train.P)
+		net = AtariA2C(env.observation_space, env.action_space)
+		agent = ptan.agent.PolicyAgent(lambda x: net(x)[0], apply_softmax=True, preprocessor=common.float32_preprocessor)
+		exp_source = common.VectorExperienceSourceFirstLast(env, agent, gamma=train.GAMMA, steps_count=train.REWARD_STEPS)
+		optimizer = optim.Adam(net.parameters(), lr=train.LEARNING_RATE)
+		buffer = RolloutBuffer(train.BATCH_SIZE, env.observation_space)
+		n_batches = 20 if quick else 200
+
+		def run(n):
+			done_batches = 0
+			for exp in exp_source:
+				buffer.append(exp)
+				if len(buffer) < train.BATCH_SIZE:
+					continue
+				states_v, actions_t, vals_ref_v = unpack_buffer(buffer, net)
+				# train.py takes the fused gradient statistics every GRAD_DIAG_INTERVAL batches only
+				train_step(net, optimizer, states_v, actions_t, vals_ref_v, fused=fused, grad_diag=not fused)
+				buffer.clear()
+				done_batches += 1
+				if done_batches == n:
+					return
+		seconds = _timed(run, n_batches)
+		key = "train/envs%d%s" % (n_envs, "_fused" if fused else "")
+		results[key] = (n_batches * train.BATCH_SIZE / seconds, "samples/s", True)
+	return results
+
+BENCHMARKS = {
+	"map_gen": bench_map_gen,
+	"env_step": bench_env_step,
+	"get_obs": bench_get_obs,
+	"net": bench_net,
+	"train": bench_train,
+}
+
+def run_benchmarks(names, repeat, quick):
+	results = {}
+	for name in names:
+		runs = [BENCHMARKS[name](quick) for _ in range(repeat)]
+		for key in runs[0]:
+			_, unit, higher_is_better = runs[0][key]
+			value = float(np.median([r[key][0] for r in runs]))
+			results[key] = {"value": value, "unit": unit, "higher_is_better": higher_is_better}
+			print("%-40s %14.3f %s" % (key, value, unit))
+			sys.stdout.flush()
+	return results
+
+def compare(results, baseline, tolerance):
+	"""Print the change against baseline results, return the keys that regressed by more than tolerance"""
+	regressions = []
+	print("%-40s %14s %14s %9s" % ("benchmark", "baseline", "current", "change"))
+	for key, result in results.items():
+		if key not in baseline:
+			continue
+		old = baseline[key]["value"]
+		new = result["value"]
+		# Positive change is always an improvement
+		change = (new - old) / old if result["higher_is_better"] else (old - new) / old
+		flag = ""
+		if change < -tolerance:
+			regressions.append(key)
+			flag = "REGRESSION"
+		print("%-40s %14.3f %14.3f %+8.1f%% %s" % (key, old, new, 100*change, flag))
+	return regressions
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="MEDA env and training benchmarks")
+	parser.add_argument("-o", "--output", default=None, help="JSON file to write the results to")
+	parser.add_argument("--baseline", default=None, help="Results JSON to compare against")
+	parser.add_argument("--tolerance", type=float, default=0.1, help="Relative slowdown reported as a regression")
+	parser.add_argument("--only", default=",".join(BENCHMARKS), help="Comma separated benchmarks to run")
+	parser.add_argument("--repeat", type=int, default=3)
+	parser.add_argument("--threads", type=int, default=1, help="torch threads, fixed for comparable numbers")
+	parser.add_argument("--quick", default=False, action="store_true", help="Less work per benchmark, for smoke runs")
+	args = parser.parse_args()
+
+	T.set_num_threads(args.threads)
+	results = run_benchmarks(args.only.split(","), args.repeat, args.quick)
+	report = {
+		"meta": {
+			"time": time.strftime("%Y-%m-%d %H:%M:%S"),
+			"python": platform.python_version(),
+			"numpy": np.__version__,
+			"torch": T.__version__,
+			"platform": platform.platform(),
+			"cpu_count": os.cpu_count(),
+			"threads": args.threads,
+			"repeat": args.repeat,
+			"quick": args.quick,
+		},
+		"results": results,
+	}
+	if args.output is not None:
+		with open(args.output, "w") as f:
+			json.dump(report, f, indent=2)
+
+	if args.baseline is not None:
+		with open(args.baseline) as f:
+			baseline = json.load(f)["results"]
+		regressions = compare(results, baseline, args.tolerance)
+		if regressions:
+			print("%d benchmarks regressed by more than %.0f%%" % (len(regressions), 100*args.tolerance))
+			sys.exit(1)
@@ -7,21 +7,17 @@ import math
 import collections
 import gym
 
+from sub_envs.map import Codes
+from sub_envs.map import encode_map
+
 class Actions(IntEnum):
 	N = 0
 	E = 1
 	S = 2
 	W = 3
 
-class Maps():
-	State = "D"
-	Goal = "G"
-	Static_module = "#"
-	Dynanic_module = "*"
-	Health = "."
-
 class MEDAEnv(gym.Env):
-	def __init__(self, w=8, h=8, p=0.9, test_flag=False):
+	def __init__(self, w=8, h=8, p=0.9, test_flag=False, copy_obs=True):
 		super(MEDAEnv, self).__init__()
 		assert w > 0 and h > 0
 		assert 0 <= p <= 1.0
@@ -36,12 +32,22 @@ class MEDAEnv(gym.Env):
 
 		self.state = (0,0)
 		self.goal = (w-1, h-1)
-		self.maps = Maps()
+		self.maps = Codes()
+		self.cells = np.array([self.maps.Health, self.maps.Static_module, self.maps.Dynamic_module], dtype=np.int8)
 		self.map = self._gen_random_map()
 #		self.m_usage = np.zeros((l, w))
 
 		self.test_flag = test_flag
 
+		# step() returns a copy of the observation buffer, or a read-only view
+		# of it that changes on the next step when copy_obs is False
+		self.copy_obs = copy_obs
+		# Planes are kept (3, h, w) like the map, obs is their (h, w, 3) view
+		self.planes = np.zeros((3, h, w))
+		self.obs = self.planes.transpose(1, 2, 0)
+		self.obs.flags.writeable = False
+		self._set_planes(self.planes, self.map)
+
 	def reset(self, test_map=None):
 		self.n_steps = 0
 		self.state = (0, 0)
@@ -49,7 +55,8 @@ class MEDAEnv(gym.Env):
 		if self.test_flag == False:
 			self.map = self._gen_random_map()
 		else:
-			self.map = test_map
+			self.map = encode_map(test_map)
+		self._set_planes(self.planes, self.map)
 
 		obs = self._get_obs()
 
@@ -66,15 +73,15 @@ class MEDAEnv(gym.Env):
 				return path
 			for x2, y2 in ((x+1, y), (x-1, y), (x, y+1), (x, y-1)):
 				if 0 <= x2 < self.w and 0 <= y2 < self.h and \
-				map[y2][x2] != self.maps.Dynanic_module and map[y2][x2] != self.maps.Static_module and (x2, y2) not in seen:
+				map[y2][x2] != self.maps.Dynamic_module and map[y2][x2] != self.maps.Static_module and (x2, y2) not in seen:
 					queue.append(path + [(x2, y2)])
 					seen.add((x2, y2))
 		return False
 
 	def _make_map(self):
-		map = np.random.choice([".", "#", '*'], (self.h, self.w), p=[self.p, (1-self.p)/2, (1-self.p)/2])
-		map[0][0] = "D"
-		map[-1][-1] = "G"
+		map = np.random.choice(self.cells, (self.h, self.w), p=[self.p, (1-self.p)/2, (1-self.p)/2])
+		map[0][0] = self.maps.State
+		map[-1][-1] = self.maps.Goal
 
 		return map
 
@@ -139,24 +146,27 @@ class MEDAEnv(gym.Env):
 		   (self.map[state_[1]][state_[0]] == self.maps.Health or self.map[state_[1]][state_[0]] == self.maps.Goal):
 #			self.m_usage[state_[1]][state_[0]] += 1
 			self.map[self.state[1]][self.state[0]] = self.maps.Health
+			self._refresh_obs(self.state)
 #			print(self.map)
 			self.state = state_
 			self.map[self.state[1]][self.state[0]] = self.maps.State
+			self._refresh_obs(self.state)
 #			print(self.map)
 
 
+	def _set_planes(self, planes, map):
+		planes[0] = map == self.maps.State
+		planes[1] = map == self.maps.Goal
+		planes[2] = (map == self.maps.Dynamic_module) | (map == self.maps.Static_module)
+
+	def _refresh_obs(self, state):
+		planes = self.planes[:, state[1]:state[1]+1, state[0]:state[0]+1]
+		self._set_planes(planes, self.map[state[1]:state[1]+1, state[0]:state[0]+1])
+
 	def _get_obs(self):
-		obs = np.zeros(shape = (self.w, self.h, 3))
-		for i in range(self.w):
-			for j in range(self.h):
-				if self.map[j][i] == self.maps.State:
-					obs[j][i][0] = 1
-				elif self.map[j][i] == self.maps.Goal:
-					obs[j][i][1] = 1
-				elif self.map[j][i] == self.maps.Dynanic_module or self.map[j][i] == self.maps.Static_module:
-					obs[j][i][2] = 1
-#		print(obs)
-		return obs
+		if self.copy_obs:
+			return self.obs.copy()
+		return self.obs
 
 	def close(self):
 		pass
\ No newline at end of file
@@ -0,0 +1,120 @@
+import os
+import re
+import sys
+import queue
+import random
+import threading
+import numpy as np
+import torch as T
+
+_NAME_RE = re.compile(r"^state_(\d+)\.pt$")
+
+def snapshot(obj):
+	"""Copy of nested dicts/lists/tuples with tensors and arrays cloned to the host"""
+	if isinstance(obj, T.Tensor):
+		return obj.detach().to("cpu", copy=True)
+	if isinstance(obj, np.ndarray):
+		return obj.copy()
+	if isinstance(obj, dict):
+		return {key: snapshot(value) for key, value in obj.items()}
+	if isinstance(obj, (list, tuple)):
+		return type(obj)(snapshot(value) for value in obj)
+	return obj
+
+def rng_state():
+	state = {
+		"python": random.getstate(),
+		"numpy": np.random.get_state(),
+		"torch": T.get_rng_state(),
+	}
+	if T.cuda.is_available():
+		state["cuda"] = T.cuda.get_rng_state_all()
+	return state
+
+def set_rng_state(state):
+	random.setstate(state["python"])
+	np.random.set_state(state["numpy"])
+	T.set_rng_state(state["torch"])
+	if "cuda" in state and T.cuda.is_available():
+		T.cuda.set_rng_state_all(state["cuda"])
+
+def _save_atomic(obj, path):
+	# Readers never see a partial file, a crash leaves at most the .tmp
+	tmp_path = path + ".tmp"
+	T.save(obj, tmp_path)
+	os.replace(tmp_path, path)
+
+def list_checkpoints(directory):
+	""":return: checkpoint paths in directory, oldest first"""
+	if not os.path.isdir(directory):
+		return []
+	names = [name for name in os.listdir(directory) if _NAME_RE.match(name)]
+	names.sort(key=lambda name: int(_NAME_RE.match(name).group(1)))
+	return [os.path.join(directory, name) for name in names]
+
+def load(path):
+	"""Load a training state, the latest one of the directory when path is a CheckpointWriter directory"""
+	if os.path.isdir(path):
+		paths = list_checkpoints(path)
+		assert paths, "no checkpoints in %s" % path
+		path = paths[-1]
+	print("... loading training state %s ..." % path)
+	return T.load(path, map_location="cpu", weights_only=False)
+
+
+class CheckpointWriter:
+	"""
+	Writes training state checkpoints (any nest of dicts with tensors and
+	arrays) from a background thread. save() only takes a snapshot copy,
+	so training goes on while the file is written. Files are written to a
+	temporary name and renamed into place, the last keep are kept. With
+	weights_path, the "model" entry is also saved there on its own, for
+	AtariA2C.load_checkpoint. A failed write is raised by the next save()
+	or close().
+	"""
+	def __init__(self, directory, keep, weights_path=None):
+		assert keep >= 1
+		self.directory = directory
+		self.keep = keep
+		self.weights_path = weights_path
+		os.makedirs(directory, exist_ok=True)
+		# Bounded so a slow disk holds back training instead of piling up snapshots
+		self.queue = queue.Queue(maxsize=2)
+		self.error = None
+		self.thread = threading.Thread(target=self._write, daemon=True)
+		self.thread.start()
+
+	def save(self, state, n_games):
+		self._raise_error()
+		self.queue.put((snapshot(state), n_games))
+
+	def close(self):
+		"""Wait for the pending checkpoints to be written"""
+		self.queue.put(None)
+		self.thread.join()
+		self._raise_error()
+
+	def _raise_error(self):
+		if self.error is not None:
+			error, self.error = self.error, None
+			raise RuntimeError("writing a training state checkpoint failed") from error
+
+	def _write(self):
+		while True:
+			item = self.queue.get()
+			if item is None:
+				break
+			state, n_games = item
+			path = os.path.join(self.directory, "state_%010d.pt" % n_games)
+			# Keep consuming the queue after a failure so save() and close() never block
+			try:
+				_save_atomic(state, path)
+				if self.weights_path is not None:
+					_save_atomic(state["model"], self.weights_path)
+				for old_path in list_checkpoints(self.directory)[:-self.keep]:
+					os.remove(old_path)
+			except Exception as error:
+				self.error = error
+				continue
+			print("... saved training state %s ..." % path)
+			sys.stdout.flush()
@@ -1,43 +1,257 @@
 import sys
 import time
+import queue
+import threading
+import collections
 import numpy as np
+import torch as T
+import torch.optim as optim
+
+from ptan.experience import ExperienceFirstLast
 
 GAMES = 30000
 EPOCHES = 300
+WRITE_EVERY = 100	#Episodes between TensorBoard summaries
+WRITE_SECONDS = 10.0	#or seconds, whichever comes first
+GOAL_REWARD = 1.0	#Last reward of an episode that reached the goal
 
 class RewardTracker:
-	def __init__(self, writer):
+	"""
+	Reward, episode length and success means over the last GAMES episodes,
+	kept as running sums over fixed-size ring buffers so an episode costs
+	O(1) and memory stays bounded. Summaries are queued every write_every episodes or
+	write_seconds seconds and written to TensorBoard by a background thread.
+	"""
+	def __init__(self, writer, write_every=WRITE_EVERY, write_seconds=WRITE_SECONDS):
 		self.writer = writer
+		self.write_every = write_every
+		self.write_seconds = write_seconds
 
 	def __enter__(self):
-		self.ts = time.time()
 		self.ts_frame = 0
-		self.total_rewards = []
-		self.total_n_steps_ep = []
+		self.rewards = np.zeros(GAMES)
+		self.n_steps_ep = np.zeros(GAMES)
+		self.goals = np.zeros(GAMES)
+		self.sum_rewards = 0.0
+		self.sum_n_steps = 0.0
+		self.sum_goals = 0.0
+		self.n_total = 0
+		self.speed = 0.0
+
+		# Episodes since the last summary
+		self.n_pending = 0
+		self.pending_rewards = 0.0
+		self.pending_n_steps = 0.0
+		self.pending_goals = 0.0
+		self.ts_summary = time.time()
+		self.frame_summary = 0
+
+		self.queue = queue.Queue()
+		self.thread = threading.Thread(target=self._write_summaries, daemon=True)
+		self.thread.start()
 		return self
 
 	def __exit__(self, *args):
+		if self.n_pending:
+			self._summary(self.ts_frame, self.n_total)
+		self.queue.put(None)
+		self.thread.join()
 		self.writer.close()
 
-	def reward(self, reward, frame, n_games):
-		self.total_rewards.append(reward)
+	def reward(self, reward, frame, n_games, goal=False):
+		"""Record a finished episode, goal tells whether it reached the goal"""
+		idx = self.n_total % GAMES
 		n_steps_ep = frame - self.ts_frame
-		self.total_n_steps_ep.append(n_steps_ep)
-		n_epoches = int(len(self.total_rewards)/GAMES)
-		speed = (frame - self.ts_frame) / (time.time() - self.ts)
 		self.ts_frame = frame
-		self.ts = time.time()
-		mean_reward = np.mean(self.total_rewards[-GAMES:])
-		mean_n_steps = np.mean(self.total_n_steps_ep[-GAMES:])
-		if len(self.total_rewards) % 1000 == 0:
+		self.sum_rewards += reward - self.rewards[idx]
+		self.sum_n_steps += n_steps_ep - self.n_steps_ep[idx]
+		self.sum_goals += goal - self.goals[idx]
+		self.rewards[idx] = reward
+		self.n_steps_ep[idx] = n_steps_ep
+		self.goals[idx] = goal
+		self.n_total += 1
+		if idx == GAMES-1:
+			# Re-sum once per window so rounding errors do not pile up
+			self.sum_rewards = self.rewards.sum()
+			self.sum_n_steps = self.n_steps_ep.sum()
+			self.sum_goals = self.goals.sum()
+
+		self.n_pending += 1
+		self.pending_rewards += reward
+		self.pending_n_steps += n_steps_ep
+		self.pending_goals += goal
+		if self.n_pending >= self.write_every or time.time() - self.ts_summary >= self.write_seconds:
+			self._summary(frame, n_games)
+
+		n_epoches = int(self.n_total/GAMES)
+		if self.n_total % 1000 == 0:
 			print("epoches/games %d/%d, avg steps %d, mean reward %.3f, speed %.2f"
-				%(n_epoches, n_games, mean_n_steps, mean_reward, speed))
+				%(n_epoches, n_games, self.mean_n_steps(), self.mean_reward(), self.speed))
 			sys.stdout.flush()
-		self.writer.add_scalar("speed", speed, n_games)
-		self.writer.add_scalar("avg reward", mean_reward, n_games)
-		self.writer.add_scalar("reward", reward, n_games)
-		self.writer.add_scalar("avg steps", n_steps_ep, n_games)
 		if n_epoches == EPOCHES:
 			print("Finish %d epoches and %d games" % (n_epoches, n_games))
 			return True
-		return False
\ No newline at end of file
+		return False
+
+	def state_dict(self):
+		"""Episode windows and counters, for resuming with load_state_dict after __enter__"""
+		return {
+			"ts_frame": self.ts_frame,
+			"n_total": self.n_total,
+			"rewards": self.rewards,
+			"n_steps_ep": self.n_steps_ep,
+			"goals": self.goals,
+		}
+
+	def load_state_dict(self, state):
+		self.ts_frame = self.frame_summary = state["ts_frame"]
+		self.n_total = state["n_total"]
+		self.rewards[:] = state["rewards"]
+		self.n_steps_ep[:] = state["n_steps_ep"]
+		self.goals[:] = state["goals"]
+		self.sum_rewards = self.rewards.sum()
+		self.sum_n_steps = self.n_steps_ep.sum()
+		self.sum_goals = self.goals.sum()
+
+	def mean_reward(self):
+		return self.sum_rewards / max(min(self.n_total, GAMES), 1)
+
+	def mean_n_steps(self):
+		return self.sum_n_steps / max(min(self.n_total, GAMES), 1)
+
+	def success_rate(self, last=None):
+		"""Share of episodes that reached the goal, over the last `last` (at most GAMES) episodes when given"""
+		if last is None or last >= min(self.n_total, GAMES):
+			return self.sum_goals / max(min(self.n_total, GAMES), 1)
+		end = self.n_total % GAMES
+		if last <= end:
+			return self.goals[end-last:end].mean()
+		return (self.goals[:end].sum() + self.goals[end-last:].sum()) / last
+
+	def _summary(self, frame, n_games):
+		now = time.time()
+		self.speed = (frame - self.frame_summary) / max(now - self.ts_summary, 1e-9)
+		self.queue.put((n_games, {
+			"speed": self.speed,
+			"avg reward": self.mean_reward(),
+			"reward": self.pending_rewards / self.n_pending,
+			"avg steps": self.pending_n_steps / self.n_pending,
+			"avg success": self.success_rate(),
+			"success": self.pending_goals / self.n_pending,
+		}))
+		self.n_pending = 0
+		self.pending_rewards = 0.0
+		self.pending_n_steps = 0.0
+		self.pending_goals = 0.0
+		self.ts_summary = now
+		self.frame_summary = frame
+
+	def _write_summaries(self):
+		while True:
+			item = self.queue.get()
+			if item is None:
+				break
+			n_games, scalars = item
+			for tag, value in scalars.items():
+				self.writer.add_scalar(tag, value, n_games)
+
+
+def float32_preprocessor(states):
+	"""Agent preprocessor that wraps an already batched float32 array without copying it"""
+	return T.from_numpy(np.asarray(states, dtype=np.float32))
+
+
+def obs_preprocessor(states):
+	"""
+	float32_preprocessor that leaves compact uint8 observations (see
+	sub_envs.obs) as they are, the net expands them on its device.
+	"""
+	states = np.asarray(states)
+	if states.dtype == np.uint8:
+		return T.from_numpy(states)
+	return T.from_numpy(states.astype(np.float32, copy=False))
+
+
+class VectorExperienceSourceFirstLast:
+	"""
+	ExperienceSourceFirstLast for envs stepping N boards per call (VectorMEDAEnv).
+	The agent sees all N states in one batch and the env resets finished boards itself.
+	"""
+	def __init__(self, env, agent, gamma, steps_count=1):
+		assert steps_count >= 1
+		self.env = env
+		self.agent = agent
+		self.gamma = gamma
+		self.steps_count = steps_count
+		self.total_rewards = []
+		self.total_steps = []
+		self.total_goals = []
+
+	def __iter__(self):
+		states = self.env.reset()
+		n_envs = len(states)
+		histories = [collections.deque(maxlen=self.steps_count) for _ in range(n_envs)]
+		agent_states = [self.agent.initial_state() for _ in range(n_envs)]
+		cur_rewards = np.zeros(n_envs)
+		cur_steps = np.zeros(n_envs, dtype=np.int64)
+
+		while True:
+			actions, agent_states = self.agent(states, agent_states)
+			next_states, rewards, dones, _ = self.env.step(actions)
+			cur_rewards += rewards
+			cur_steps += 1
+
+			for idx in range(n_envs):
+				history = histories[idx]
+				history.append((states[idx], actions[idx], rewards[idx]))
+				if dones[idx]:
+					# next_states holds the first state of the new episode here
+					while history:
+						yield self._first_last(history, None)
+						history.popleft()
+					self.total_rewards.append(cur_rewards[idx])
+					self.total_steps.append(cur_steps[idx])
+					self.total_goals.append(rewards[idx] == GOAL_REWARD)
+					cur_rewards[idx] = 0.0
+					cur_steps[idx] = 0
+					agent_states[idx] = self.agent.initial_state()
+				elif len(history) == self.steps_count:
+					yield self._first_last(history, next_states[idx])
+			states = next_states
+
+	def _first_last(self, history, last_state):
+		total_reward = 0.0
+		for _, _, reward in reversed(history):
+			total_reward *= self.gamma
+			total_reward += reward
+		state, action, _ = history[0]
+		return ExperienceFirstLast(state=state, action=action, reward=total_reward, last_state=last_state)
+
+	def pop_total_rewards(self):
+		r = self.total_rewards
+		if r:
+			self.total_rewards = []
+			self.total_steps = []
+			self.total_goals = []
+		return r
+
+	def pop_episodes(self):
+		""":return: (total reward, goal reached) of the episodes finished since the last pop"""
+		episodes = list(zip(self.total_rewards, self.total_goals))
+		self.pop_total_rewards()
+		return episodes
+
+
+class SharedAdam(optim.Adam):
+	"""
+	Adam whose moment estimates live in shared memory, so asynchronous workers
+	holding the same instance all update one optimizer state.
+	"""
+	def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8, weight_decay=0):
+		super(SharedAdam, self).__init__(params, lr=lr, betas=betas, eps=eps, weight_decay=weight_decay)
+		for group in self.param_groups:
+			for p in group["params"]:
+				state = self.state[p]
+				state["step"] = T.zeros(()).share_memory_()
+				state["exp_avg"] = T.zeros_like(p.data).share_memory_()
+				state["exp_avg_sq"] = T.zeros_like(p.data).share_memory_()
@@ -0,0 +1,97 @@
+import sys
+import collections
+
+Stage = collections.namedtuple("Stage", ["w", "h", "dsize", "p"])
+
+# Board size and droplet size grow stage by stage, towards 16x16 boards with
+# 3x3 droplets. The last stage has fewer modules (p=0.9) since MakeMap
+# hardly finds 16x16 dsize 3 boards at p=0.8 (a few maps/s).
+STAGES = [
+	Stage(8, 8, 1, 0.9),
+	Stage(8, 8, 2, 0.9),
+	Stage(8, 8, 2, 0.8),
+	Stage(12, 12, 2, 0.8),
+	Stage(16, 16, 2, 0.8),
+	Stage(16, 16, 3, 0.9),
+]
+TARGET = 0.8	#Success rate that ends a stage
+WINDOW = 2000	#Games of the stage the success rate is taken over
+
+class Curriculum:
+	"""
+	Trains on stages of harder boards, moving on once the RewardTracker
+	success rate over the last window games of the current stage reaches
+	target. The net has to accept every stage's boards (FCA2C), so the
+	weights carry over from one stage to the next.
+	"""
+	def __init__(self, stages=STAGES, target=TARGET, window=WINDOW):
+		assert len(stages) > 0
+		self.stages = [Stage(*stage) for stage in stages]
+		self.target = target
+		self.window = window
+		self.stage_idx = 0
+		self.games_start = 0
+		self.frames_start = 0
+		# Games and frames at which each stage reached target
+		self.reached = []
+		self.source = None
+
+	@property
+	def stage(self):
+		return self.stages[self.stage_idx]
+
+	def update(self, tracker, frame, n_games):
+		"""Check the success rate after a finished game, return True when the next stage starts"""
+		if n_games - self.games_start < self.window or len(self.reached) > self.stage_idx:
+			return False
+		success = tracker.success_rate(self.window)
+		if success < self.target:
+			return False
+
+		self.reached.append((n_games, frame))
+		print("curriculum: stage %d %dx%d dsize %d p %.2f reached success %.3f after %d games, %d frames (%d in stage)"
+			% (self.stage_idx, self.stage.w, self.stage.h, self.stage.dsize, self.stage.p, success,
+				n_games, frame, frame - self.frames_start))
+		sys.stdout.flush()
+		if self.stage_idx == len(self.stages) - 1:
+			return False
+		self.stage_idx += 1
+		self.games_start = n_games
+		self.frames_start = frame
+		return True
+
+	def state_dict(self):
+		return {
+			"stage_idx": self.stage_idx,
+			"games_start": self.games_start,
+			"frames_start": self.frames_start,
+			"reached": list(self.reached),
+		}
+
+	def load_state_dict(self, state):
+		self.stage_idx = state["stage_idx"]
+		self.games_start = state["games_start"]
+		self.frames_start = state["frames_start"]
+		self.reached = list(state["reached"])
+
+	def write(self, writer, n_games):
+		writer.add_scalar("curriculum stage", self.stage_idx, n_games)
+		writer.add_scalar("curriculum board cells", self.stage.w * self.stage.h, n_games)
+
+	def experiences(self, make_source, source=None):
+		"""
+		Iterate over make_source(stage) experience sources, a new one for the
+		stage whenever update() advanced, starting with source when given.
+		The current one is self.source.
+		"""
+		self.source = source
+		while True:
+			stage_idx = self.stage_idx
+			if self.source is None:
+				self.source = make_source(self.stage)
+			for exp in self.source:
+				yield exp
+				if self.stage_idx != stage_idx:
+					break
+			self.source.env.close()
+			self.source = None
@@ -0,0 +1,138 @@
+import sys
+import json
+import time
+import cProfile
+import pstats
+import functools
+import contextlib
+import collections
+
+import torch as T
+
+class PhaseProfiler:
+	"""
+	Wall-clock timers and call/sample counters for named phases of the
+	training loop. Methods are timed by instrument(), code blocks by phase().
+	Phases nest, so the time of an outer phase (e.g. the env step) includes
+	the inner ones (e.g. map generation on reset). A disabled profiler
+	instruments nothing and its phase() is a no-op.
+	"""
+	def __init__(self, enabled=True):
+		self.enabled = enabled
+		self.seconds = collections.defaultdict(float)
+		self.calls = collections.defaultdict(int)
+		self.samples = collections.defaultdict(int)
+		self.ts_start = time.perf_counter()
+		self._null = contextlib.nullcontext()
+
+	def instrument(self, obj, attr, name, samples=0):
+		"""Replace the callable obj.attr by a timed wrapper counting samples per call"""
+		if not self.enabled:
+			return
+		func = getattr(obj, attr)
+
+		@functools.wraps(func)
+		def timed(*args, **kwargs):
+			ts = time.perf_counter()
+			try:
+				return func(*args, **kwargs)
+			finally:
+				self.seconds[name] += time.perf_counter() - ts
+				self.calls[name] += 1
+				self.samples[name] += samples
+		setattr(obj, attr, timed)
+
+	def phase(self, name, samples=0):
+		if not self.enabled:
+			return self._null
+		return self._timed(name, samples)
+
+	@contextlib.contextmanager
+	def _timed(self, name, samples):
+		ts = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.seconds[name] += time.perf_counter() - ts
+			self.calls[name] += 1
+			self.samples[name] += samples
+
+	def summary(self):
+		"""Per phase: seconds, share of the wall time, calls/s and samples/s"""
+		wall = time.perf_counter() - self.ts_start
+		phases = {}
+		for name in self.seconds:
+			phases[name] = {
+				"seconds": self.seconds[name],
+				"fraction": self.seconds[name] / wall,
+				"calls": self.calls[name],
+				"calls_per_sec": self.calls[name] / wall,
+				"samples_per_sec": self.samples[name] / wall,
+				"ms_per_call": 1000 * self.seconds[name] / max(self.calls[name], 1),
+			}
+		return {"wall_seconds": wall, "phases": phases}
+
+	def write(self, writer, step):
+		if not self.enabled:
+			return
+		for name, stats in self.summary()["phases"].items():
+			writer.add_scalar("profile/%s fraction" % name, stats["fraction"], step)
+			writer.add_scalar("profile/%s calls per sec" % name, stats["calls_per_sec"], step)
+			if stats["samples_per_sec"]:
+				writer.add_scalar("profile/%s samples per sec" % name, stats["samples_per_sec"], step)
+
+	def dump(self, path):
+		if not self.enabled:
+			return
+		summary = self.summary()
+		with open(path, "w") as f:
+			json.dump(summary, f, indent=2)
+		print("%-20s %10s %8s %12s %12s %10s" % ("phase", "seconds", "share", "calls/s", "samples/s", "ms/call"))
+		for name, stats in sorted(summary["phases"].items(), key=lambda kv: -kv[1]["seconds"]):
+			print("%-20s %10.2f %8.3f %12.1f %12.1f %10.3f" % (name, stats["seconds"], stats["fraction"],
+				stats["calls_per_sec"], stats["samples_per_sec"], stats["ms_per_call"]))
+		sys.stdout.flush()
+
+
+class CaptureWindow:
+	"""
+	Runs cProfile or torch.profiler over batches [start, start+n_batches) of
+	the training loop; step() is called once per batch. The capture is saved
+	to path (.prof for cProfile, a Chrome trace .json for torch) and its top
+	entries are printed.
+	"""
+	def __init__(self, kind, start, n_batches, path):
+		assert kind in ("cprofile", "torch"), "unknown capture %s" % kind
+		self.kind = kind
+		self.start = start
+		self.stop = start + n_batches
+		self.path = path
+		self.n_batches = 0
+		self.profiler = None
+
+	def step(self):
+		if self.n_batches == self.start:
+			self._begin()
+		self.n_batches += 1
+		if self.n_batches == self.stop:
+			self._end()
+
+	def _begin(self):
+		if self.kind == "cprofile":
+			self.profiler = cProfile.Profile()
+			self.profiler.enable()
+		else:
+			self.profiler = T.profiler.profile(record_shapes=True)
+			self.profiler.__enter__()
+
+	def _end(self):
+		if self.kind == "cprofile":
+			self.profiler.disable()
+			self.profiler.dump_stats(self.path + ".prof")
+			pstats.Stats(self.profiler).sort_stats("cumulative").print_stats(25)
+		else:
+			self.profiler.__exit__(None, None, None)
+			self.profiler.export_chrome_trace(self.path + ".json")
+			print(self.profiler.key_averages().table(sort_by="cpu_time_total", row_limit=25))
+		sys.stdout.flush()
+		self.profiler = None
@@ -0,0 +1,255 @@
+import collections
+import numpy as np
+import torch as T
+import torch.nn.functional as F
+
+from lib import common
+
+ExperienceFirstLastValue = collections.namedtuple("ExperienceFirstLastValue", ("state", "action", "reward", "last_state", "last_value"))
+Rollout = collections.namedtuple("Rollout", ("states", "actions", "rewards", "dones", "values", "last_values"))
+
+
+class RolloutBuffer:
+	"""
+	Batch of first/last experiences kept in preallocated float32 tensors, pinned
+	when the learner runs on CUDA. Experiences are written into slots as they
+	arrive and batch() hands out views of the filled part, so no batch is ever
+	assembled from Python lists.
+
+	With cached_values the experiences carry the value of their last state
+	(ExperienceFirstLastValue), which is stored instead of the last state.
+	Compact observations (see sub_envs.obs) are kept with obs_dtype=T.uint8.
+	"""
+	def __init__(self, capacity, obs_shape, device="cpu", cached_values=False, obs_dtype=T.float32):
+		self.capacity = capacity
+		self.cached_values = cached_values
+		self.pin_memory = T.device(device).type == "cuda"
+		obs_shape = tuple(obs_shape)
+		self.states = T.zeros((capacity,) + obs_shape, dtype=obs_dtype, pin_memory=self.pin_memory)
+		self.actions = T.zeros(capacity, dtype=T.long, pin_memory=self.pin_memory)
+		self.rewards = T.zeros(capacity, dtype=T.float32, pin_memory=self.pin_memory)
+		self.last_states = T.zeros((capacity,) + obs_shape, dtype=obs_dtype, pin_memory=self.pin_memory)
+		self.not_done = T.zeros(capacity, dtype=T.float32, pin_memory=self.pin_memory)
+		self.last_values = T.zeros(capacity, dtype=T.float32, pin_memory=self.pin_memory)
+
+		# NumPy views of the same memory, cheaper to write one slot at a time
+		self._states = self.states.numpy()
+		self._actions = self.actions.numpy()
+		self._rewards = self.rewards.numpy()
+		self._last_states = self.last_states.numpy()
+		self._not_done = self.not_done.numpy()
+		self._last_values = self.last_values.numpy()
+
+		self.size = 0
+		self._copied = None
+
+	def __len__(self):
+		return self.size
+
+	def append(self, exp):
+		assert self.size < self.capacity
+		idx = self.size
+		self._states[idx] = exp.state
+		self._actions[idx] = exp.action
+		self._rewards[idx] = exp.reward
+		if exp.last_state is not None:
+			if self.cached_values:
+				self._last_values[idx] = exp.last_value
+			else:
+				self._last_states[idx] = exp.last_state
+			self._not_done[idx] = 1.0
+		else:
+			# Stale last state or value in this slot is masked out by not_done
+			self._not_done[idx] = 0.0
+		self.size += 1
+
+	def batch(self, device="cpu"):
+		"""states, actions, rewards, last_states, not_done and last_values of the filled slots"""
+		n = self.size
+		tensors = (self.states[:n], self.actions[:n], self.rewards[:n], self.last_states[:n], self.not_done[:n], self.last_values[:n])
+		if not self.pin_memory:
+			return tuple(t.to(device) for t in tensors)
+		tensors = tuple(t.to(device, non_blocking=True) for t in tensors)
+		# Slots may only be overwritten once the asynchronous copies are done
+		self._copied = T.cuda.Event()
+		self._copied.record()
+		return tensors
+
+	def clear(self):
+		if self._copied is not None:
+			self._copied.synchronize()
+			self._copied = None
+		self.size = 0
+
+
+class ValueExperienceSourceFirstLast(common.VectorExperienceSourceFirstLast):
+	"""
+	n-step first/last experiences from a vector env, acting with one forward of
+	the actor-critic net per step. The value computed for a state when its
+	action is picked is kept, and becomes the last_value of the experience that
+	bootstraps from that state, so targets need no second forward pass.
+	Experiences that bootstrap are emitted one step late, once that value exists.
+	"""
+	def __init__(self, env, net, gamma, steps_count=1, device="cpu"):
+		super(ValueExperienceSourceFirstLast, self).__init__(env, None, gamma, steps_count=steps_count)
+		self.net = net
+		self.device = device
+
+	def __iter__(self):
+		states = self.env.reset()
+		n_envs = len(states)
+		histories = [collections.deque(maxlen=self.steps_count) for _ in range(n_envs)]
+		cur_rewards = np.zeros(n_envs)
+		cur_steps = np.zeros(n_envs, dtype=np.int64)
+		# (env index, first experience) waiting for the value of the current state
+		pending = []
+
+		while True:
+			states_v = common.obs_preprocessor(states).to(self.device)
+			with T.no_grad():
+				logits_v, values_v = self.net(states_v)
+				actions = T.multinomial(F.softmax(logits_v, dim=1), 1).squeeze(-1).cpu().numpy()
+			values = values_v.squeeze(-1).cpu().numpy()
+
+			for idx, exp in pending:
+				yield exp._replace(last_state=states[idx], last_value=float(values[idx]))
+			pending.clear()
+
+			next_states, rewards, dones, _ = self.env.step(actions)
+			cur_rewards += rewards
+			cur_steps += 1
+
+			for idx in range(n_envs):
+				history = histories[idx]
+				history.append((states[idx], actions[idx], rewards[idx]))
+				if dones[idx]:
+					while history:
+						yield self._first_last(history, None)
+						history.popleft()
+					self.total_rewards.append(cur_rewards[idx])
+					self.total_steps.append(cur_steps[idx])
+					self.total_goals.append(rewards[idx] == common.GOAL_REWARD)
+					cur_rewards[idx] = 0.0
+					cur_steps[idx] = 0
+				elif len(history) == self.steps_count:
+					pending.append((idx, self._first_last(history, None)))
+			states = next_states
+
+	def _first_last(self, history, last_state):
+		exp = super(ValueExperienceSourceFirstLast, self)._first_last(history, last_state)
+		return ExperienceFirstLastValue(state=exp.state, action=exp.action, reward=exp.reward, last_state=last_state, last_value=0.0)
+
+
+class VectorRollout:
+	"""
+	Steps a vector env rollout_steps times per iteration with one forward of the
+	actor-critic net per step, and yields the segment as (T, N) tensors on the
+	net's device: states, actions, rewards, dones, values, plus the (N,) values
+	of the states following the segment. The tensors are reused by the next
+	iteration, so a segment must be consumed before asking for another one.
+	"""
+	def __init__(self, env, net, rollout_steps, device="cpu"):
+		assert rollout_steps >= 1
+		self.env = env
+		self.net = net
+		self.rollout_steps = rollout_steps
+		self.device = device
+		self.total_rewards = []
+		self.total_steps = []
+		self.total_goals = []
+
+	def __iter__(self):
+		states = self.env.reset()
+		n_envs = len(states)
+		shape = (self.rollout_steps, n_envs)
+		obs_dtype = common.obs_preprocessor(states).dtype
+		rollout = Rollout(
+			states=T.zeros(shape + tuple(self.env.observation_space), dtype=obs_dtype, device=self.device),
+			actions=T.zeros(shape, dtype=T.long, device=self.device),
+			rewards=T.zeros(shape, dtype=T.float32, device=self.device),
+			dones=T.zeros(shape, dtype=T.float32, device=self.device),
+			values=T.zeros(shape, dtype=T.float32, device=self.device),
+			last_values=T.zeros(n_envs, dtype=T.float32, device=self.device))
+		cur_rewards = np.zeros(n_envs)
+		cur_steps = np.zeros(n_envs, dtype=np.int64)
+
+		while True:
+			for t in range(self.rollout_steps):
+				rollout.states[t] = common.obs_preprocessor(states)
+				with T.no_grad():
+					logits_v, values_v = self.net(rollout.states[t])
+					actions_v = T.multinomial(F.softmax(logits_v, dim=1), 1).squeeze(-1)
+				rollout.actions[t] = actions_v
+				rollout.values[t] = values_v.squeeze(-1)
+
+				states, rewards, dones, _ = self.env.step(actions_v.cpu().numpy())
+				rollout.rewards[t] = T.from_numpy(np.asarray(rewards, dtype=np.float32))
+				rollout.dones[t] = T.from_numpy(np.asarray(dones, dtype=np.float32))
+
+				cur_rewards += rewards
+				cur_steps += 1
+				for idx in np.nonzero(dones)[0]:
+					self.total_rewards.append(cur_rewards[idx])
+					self.total_steps.append(cur_steps[idx])
+					self.total_goals.append(rewards[idx] == common.GOAL_REWARD)
+					cur_rewards[idx] = 0.0
+					cur_steps[idx] = 0
+
+			with T.no_grad():
+				states_v = common.obs_preprocessor(states).to(self.device)
+				rollout.last_values[:] = self.net(states_v)[1].squeeze(-1)
+			yield rollout
+
+	def pop_total_rewards(self):
+		r = self.total_rewards
+		if r:
+			self.total_rewards = []
+			self.total_steps = []
+			self.total_goals = []
+		return r
+
+	def pop_episodes(self):
+		""":return: (total reward, goal reached) of the episodes finished since the last pop"""
+		episodes = list(zip(self.total_rewards, self.total_goals))
+		self.pop_total_rewards()
+		return episodes
+
+
+def nstep_returns(rewards, dones, values, last_values, gamma, steps_count):
+	"""
+	steps_count-step discounted returns of a (T, N) rollout. The sum stops at
+	episode ends; otherwise it bootstraps from the value steps_count steps ahead,
+	or from last_values for steps closer than that to the end of the rollout.
+	Vectorized over time and envs, the loop only runs over the steps_count offsets.
+	"""
+	n_steps = rewards.shape[0]
+	next_values = T.cat((values, last_values.unsqueeze(0)))
+	steps = T.arange(n_steps, device=rewards.device)
+	returns = T.zeros_like(rewards)
+	alive = T.ones_like(rewards)
+	for k in range(steps_count):
+		idx = steps + k
+		valid = (idx < n_steps).to(rewards.dtype).unsqueeze(1)
+		idx = idx.clamp(max=n_steps-1)
+		returns += gamma**k * alive * valid * rewards[idx]
+		alive = alive * (1.0 - valid * dones[idx])
+	end = (steps + steps_count).clamp(max=n_steps)
+	discount = T.pow(T.full_like(rewards[:, 0], gamma), (end - steps).to(rewards.dtype))
+	return returns + discount.unsqueeze(1) * alive * next_values[end]
+
+
+def gae_advantages(rewards, dones, values, last_values, gamma, gae_lambda):
+	"""
+	GAE(lambda) advantages of a (T, N) rollout by a reverse scan over time.
+	:return: advantages, reference values (advantages + values)
+	"""
+	advantages = T.zeros_like(rewards)
+	last_adv = T.zeros_like(last_values)
+	next_values = last_values
+	for t in reversed(range(rewards.shape[0])):
+		not_done = 1.0 - dones[t]
+		delta = rewards[t] + gamma * next_values * not_done - values[t]
+		last_adv = delta + gamma * gae_lambda * not_done * last_adv
+		advantages[t] = last_adv
+		next_values = values[t]
+	return advantages, advantages + values
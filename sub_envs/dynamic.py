@@ -7,8 +7,10 @@ import math
 import collections
 import gym
 
-from map import MakeMap
-from map import Symbols
+from sub_envs.map import MakeMap
+from sub_envs.map import Codes
+from sub_envs.map import encode_map
+from sub_envs.obs import obs_dtype, obs_shape, observation_space, layout_view, pack_obs
 
 class Actions(IntEnum):
 	N = 0
@@ -17,7 +19,7 @@ class Actions(IntEnum):
 	W = 3
 
 class MEDAEnv(gym.Env):
-	def __init__(self, w=8, h=8, dsize=2, p=0.9, test_flag=False):
+	def __init__(self, w=8, h=8, dsize=2, p=0.9, test_flag=False, copy_obs=True, map_bank=None, prefetcher=None, obs_mode="float", obs_layout="whc"):
 		super(MEDAEnv, self).__init__()
 		assert w > 0 and h > 0
 		assert 0 <= p <= 1.0
@@ -27,19 +29,39 @@ class MEDAEnv(gym.Env):
 		self.p = p
 		self.actions = Actions
 		self.action_space = len(self.actions)
-		self.observation_space = (w, h, 3)
+		self.obs_shape = obs_shape(w, h, obs_layout)
+		self.obs_mode = obs_mode
+		self.obs_layout = obs_layout
+		self.observation_space = observation_space(self.obs_shape, obs_mode)
 		self.n_steps = 0
 		self.max_step = 2*(self.w+self.h)
 
 		self.state = (0,0)
 		self.goal = (w-1, h-1)
 
-		self.map_symbols = Symbols()
+		self.map_symbols = Codes()
 		self.mapclass = MakeMap(w=self.w,h=self.h,dsize=self.dsize,p=self.p)
-		self.map = self.mapclass.gen_random_map()
+		# Boards are sampled from a pre-generated MapBank when one is given,
+		# otherwise taken from a MapPrefetcher if it has one ready
+		self.map_bank = map_bank
+		if self.map_bank is not None:
+			self.map_bank.check(w, h, dsize)
+		self.prefetcher = prefetcher
+		if self.prefetcher is not None:
+			self.prefetcher.check(w, h, dsize)
+		self.map = self._gen_random_map()
 
 		self.test_flag = test_flag
 
+		# step() returns a copy of the observation buffer, or a read-only view
+		# of it that changes on the next step when copy_obs is False
+		self.copy_obs = copy_obs
+		# Planes are kept (3, h, w) like the map, obs is their view in obs_layout
+		self.planes = np.zeros((3, h, w), dtype=obs_dtype(obs_mode))
+		self.obs = layout_view(self.planes, obs_layout)
+		self.obs.flags.writeable = False
+		self._set_planes(self.planes, self.map)
+
 		self.dynamic_flag = 0
 		self.dynamic_state = (0,0)
 
@@ -48,14 +70,24 @@ class MEDAEnv(gym.Env):
 		self.state = (0, 0)
 
 		if self.test_flag == False:
-			self.map = self.mapclass.gen_random_map()
+			self.map = self._gen_random_map()
 		else:
-			self.map = test_map
+			self.map = encode_map(test_map)
+		self._set_planes(self.planes, self.map)
 
 		obs = self._get_obs()
 
 		return obs
 
+	def _gen_random_map(self):
+		if self.map_bank is not None:
+			return self.map_bank.sample()
+		if self.prefetcher is not None:
+			map = self.prefetcher.get()
+			if map is not None:
+				return map
+		return self.mapclass.gen_random_map()
+
 	def step(self, action):
 		done = False
 		message = None
@@ -98,21 +130,11 @@ class MEDAEnv(gym.Env):
 		diff_y = state1[0] - state2[0]
 		return math.sqrt(diff_x*diff_x + diff_y*diff_y)
 
+	def _footprint(self, dstate):
+		return self.map[dstate[1]:dstate[1]+self.dsize, dstate[0]:dstate[0]+self.dsize]
+
 	def _is_touching(self, dstate, obj):
-		i = 0
-		while True:
-			j = 0
-			while True:
-				if self.map[dstate[1]+j][dstate[0]+i] == obj:
-					return True
-				j += 1
-				if j == self.dsize:
-					break
-			i += 1
-			if i == self.dsize:
-				break
-
-		return False
+		return (self._footprint(dstate) == obj).any()
 
 	def _update_position(self, action):
 		state_ = list(self.state)
@@ -129,63 +151,42 @@ class MEDAEnv(gym.Env):
 		if (0 <= state_[1] < self.h-self.dsize+1) and (0 <= state_[0] < self.w-self.dsize+1) and\
 		   (self._is_touching(state_, self.map_symbols.Dynamic_module) == False) and (self._is_touching(state_, self.map_symbols.Static_module) == False):
 #			print("okok")
-			i = 0
-			while True:
-				j = 0
-				while True:
-					self.map[self.state[1]+j][self.state[0]+i] = self.map_symbols.Health
-					j += 1
-					if j == self.dsize:
-						break
-				i += 1
-				if i == self.dsize:
-					break
+			_state = self.state
+			self._footprint(self.state)[:] = self.map_symbols.Health
 
 			self.state = state_
 
 			# Set Droplet state
-			i = 0
-			while True:
-				j = 0
-				while True:
-					self.map[self.state[1]+j][self.state[0]+i] = self.map_symbols.State
-					j += 1
-					if j == self.dsize:
-						break
-				i += 1
-				if i == self.dsize:
-					break
+			self._footprint(self.state)[:] = self.map_symbols.State
+
+			# Only the cells the droplet left and entered change
+			self._refresh_obs(_state)
+			self._refresh_obs(self.state)
 
 		elif (0 <= state_[1] < self.h-self.dsize+1) and (0 <= state_[0] < self.w-self.dsize+1) and\
 		   (self._is_touching(state_, self.map_symbols.Dynamic_module) == True):
 			self.dynamic_flag += 1
 			self.dynamic_state = state_
 
-			i = 0
-			while True:
-				j = 0
-				while True:
-					if self.map[state_[1]+j][state_[0]+i] == self.map_symbols.Dynamic_module:
-						self.map[state_[1]+j][state_[0]+i] = self.map_symbols.Static_module
-					j += 1
-					if j == self.dsize:
-						break
-				i += 1
-				if i == self.dsize:
-					break
+			footprint = self._footprint(state_)
+			footprint[footprint == self.map_symbols.Dynamic_module] = self.map_symbols.Static_module
+			self._refresh_obs(state_)
+
+	def _set_planes(self, planes, map):
+		planes[0] = map == self.map_symbols.State
+		planes[1] = map == self.map_symbols.Goal
+		planes[2] = map == self.map_symbols.Static_module
+
+	def _refresh_obs(self, dstate):
+		planes = self.planes[:, dstate[1]:dstate[1]+self.dsize, dstate[0]:dstate[0]+self.dsize]
+		self._set_planes(planes, self._footprint(dstate))
 
 	def _get_obs(self):
-		obs = np.zeros(shape = (self.w, self.h, 3))
-		for i in range(self.w):
-			for j in range(self.h):
-				if self.map[j][i] == self.map_symbols.State:
-					obs[i][j][0] = 1
-				elif self.map[j][i] == self.map_symbols.Goal:
-					obs[i][j][1] = 1
-				elif self.map[j][i] == self.map_symbols.Static_module:
-					obs[i][j][2] = 1
-#		print(obs)
-		return obs
+		if self.obs_mode == "packed":
+			return pack_obs(self.obs)
+		if self.copy_obs:
+			return self.obs.copy()
+		return self.obs
 
 	def close(self):
 		pass
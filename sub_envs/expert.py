@@ -0,0 +1,88 @@
+import argparse
+import numpy as np
+
+from sub_envs.map import MakeMap
+from sub_envs.oracle import MOVES, distance_field
+from sub_envs.vector import VectorMEDAEnv
+
+# Dataset layout (np.savez): observations are 0/1 planes, bit-packed per
+# sample into obs (n, ceil(w*h*3/8)) uint8, actions (n,) int8, the
+# observation shape in obs_shape and the boards' w, h, dsize and the
+# observation layout (obs_layout) they were played with.
+
+def expert_actions(fields, states):
+	"""
+	One shortest-route action per board, picked at random among the optimal
+	ones. fields are (N, rows, cols) distance fields, states (N, 2) as (x, y).
+	"""
+	env_idx = np.arange(len(states))
+	dist = fields[env_idx, states[:, 1], states[:, 0]]
+	nexts = states[:, None, :] + MOVES[None]
+	rows, cols = fields.shape[1:]
+	inside = (nexts[..., 0] >= 0) & (nexts[..., 0] < cols) & (nexts[..., 1] >= 0) & (nexts[..., 1] < rows)
+	xs = np.clip(nexts[..., 0], 0, cols-1)
+	ys = np.clip(nexts[..., 1], 0, rows-1)
+	optimal = inside & (fields[env_idx[:, None], ys, xs] == dist[:, None] - 1)
+	return np.argmax(optimal * np.random.random(optimal.shape), axis=1)
+
+def expert_games(env, maps):
+	"""
+	Play maps on env (a VectorMEDAEnv without auto_reset) along shortest
+	routes. Returns the bit-packed observations and actions of every move.
+	"""
+	fields = np.array([distance_field(map, env.dsize) for map in maps])
+	obs = env.reset(maps=maps)
+	active = np.ones(len(maps), dtype=bool)
+	packed, actions = [], []
+	while active.any():
+		action = expert_actions(fields, env.states)
+		packed.append(np.packbits(obs[active].astype(np.uint8).reshape(active.sum(), -1), axis=1))
+		actions.append(action[active].astype(np.int8))
+		obs, _, done, _ = env.step(action)
+		active &= ~done
+	return np.concatenate(packed), np.concatenate(actions)
+
+def build_dataset(path, w, h, dsize, p, n_maps, batch=1024, seed=0):
+	"""Write the expert moves on n_maps random MakeMap boards to path"""
+	np.random.seed(seed)
+	mapclass = MakeMap(w=w, h=h, dsize=dsize, p=p)
+	env = None
+	packed, actions = [], []
+	for start in range(0, n_maps, batch):
+		maps = np.array([mapclass.gen_random_map() for _ in range(min(batch, n_maps-start))])
+		if env is None or env.n_envs != len(maps):
+			env = VectorMEDAEnv(n_envs=len(maps), w=w, h=h, dsize=dsize, p=p, auto_reset=False)
+		o, a = expert_games(env, maps)
+		packed.append(o)
+		actions.append(a)
+		print("played %d/%d maps, %d moves" % (start+len(maps), n_maps, sum(len(a) for a in actions)))
+	np.savez(path, obs=np.concatenate(packed), actions=np.concatenate(actions), obs_shape=np.array(env.observation_space),
+		w=w, h=h, dsize=dsize, obs_layout=env.obs_layout)
+
+def dataset_info(path):
+	""":return: dict of the boards' w, h, dsize and the obs_layout, None for datasets written without them"""
+	data = np.load(path)
+	if "obs_layout" not in data:
+		return None
+	return {"w": int(data["w"]), "h": int(data["h"]), "dsize": int(data["dsize"]), "obs_layout": str(data["obs_layout"])}
+
+def load_dataset(path):
+	""":return: observations (n, *obs_shape) uint8 in the dataset's obs_layout, actions (n,) int64"""
+	data = np.load(path)
+	obs_shape = tuple(data["obs_shape"])
+	obs = np.unpackbits(data["obs"], axis=1, count=int(np.prod(obs_shape)))
+	return obs.reshape((-1,) + obs_shape), data["actions"].astype(np.int64)
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Generate shortest-route expert moves on MEDA boards")
+	parser.add_argument("-o", "--output", required=True, help="Dataset file to write (.npz)")
+	parser.add_argument("-n", "--num-maps", type=int, default=100000, help="Number of boards to play")
+	parser.add_argument("--w", type=int, default=8)
+	parser.add_argument("--h", type=int, default=8)
+	parser.add_argument("--dsize", type=int, default=2)
+	parser.add_argument("-p", type=float, default=0.8, help="Probability of a healthy cell")
+	parser.add_argument("--seed", type=int, default=0)
+	args = parser.parse_args()
+
+	build_dataset(args.output, args.w, args.h, args.dsize, args.p, args.num_maps, seed=args.seed)
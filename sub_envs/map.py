@@ -14,6 +14,44 @@ class Symbols():
 	Dynamic_module = "*"
 	Health = "."
 
+class Codes():
+	Health = 0
+	State = 1
+	Goal = 2
+	Static_module = 3
+	Dynamic_module = 4
+
+# Legacy string symbol of every code, indexed by code
+_SYMBOLS = np.array([Symbols.Health, Symbols.State, Symbols.Goal, Symbols.Static_module, Symbols.Dynamic_module])
+
+def encode_map(map):
+	"""Convert a legacy string board ("D", "G", "#", "*", ".") into int8 codes"""
+	map = np.asarray(map)
+	if map.dtype.kind != "U":
+		return map.astype(np.int8, copy=False)
+	codes = np.full(map.shape, Codes.Health, dtype=np.int8)
+	for code, symbol in enumerate(_SYMBOLS):
+		codes[map == symbol] = code
+	return codes
+
+def decode_map(map):
+	"""Convert an int8 board back into the legacy string form, e.g. for printing"""
+	return _SYMBOLS[np.asarray(map)]
+
+def blocked_footprint(map, dsize):
+	"""
+	Mask over droplet positions, shape (h-dsize+1, w-dsize+1), that is True
+	where the dsize x dsize footprint covers a module. Window sums come from a
+	2D prefix sum, so every position is checked in O(1).
+	"""
+	modules = (map == Codes.Static_module) | (map == Codes.Dynamic_module)
+	h, w = map.shape
+	integral = np.zeros((h+1, w+1), dtype=np.int32)
+	integral[1:, 1:] = modules.cumsum(axis=0).cumsum(axis=1)
+	d = dsize
+	counts = integral[d:, d:] - integral[:-d, d:] - integral[d:, :-d] + integral[:-d, :-d]
+	return counts > 0
+
 class MakeMap():
 	def __init__(self, w, h, dsize, p):
 		super(MakeMap, self).__init__()
@@ -24,86 +62,96 @@ class MakeMap():
 		self.dsize = dsize
 		self.p = p
 
-		self.symbols = Symbols()
+		self.symbols = Codes()
+		self.cells = np.array([self.symbols.Health, self.symbols.Static_module, self.symbols.Dynamic_module], dtype=np.int8)
 		self.map = self._make_map()
 
+		# Boards drawn and boards accepted by gen_random_map
+		self.n_attempts = 0
+		self.n_maps = 0
+
 	def _make_map(self):
-		map = np.random.choice([".", "#", '*'], (self.h, self.w), p=[self.p, (1-self.p)/2, (1-self.p)/2])
-		i = 0
+		map = np.random.choice(self.cells, (self.h, self.w), p=[self.p, (1-self.p)/2, (1-self.p)/2])
 
 		# Set droplet
-		while True:
-			j = 0
-			while True:
-				map[j][i] = "D"
-				j += 1
-				if j == self.dsize:
-					break
-			i += 1
-			if i == self.dsize:
-				break
+		map[:self.dsize, :self.dsize] = self.symbols.State
 
 		# Set around the goal
-		i = 0
-		while True:
-			j = 0
-			while True:
-				map[self.h-i-1][self.w-j-1] = "."
-				j += 1
-				if j == self.dsize:
-					break
-			i += 1
-			if i == self.dsize:
-				break
+		map[self.h-self.dsize:, self.w-self.dsize:] = self.symbols.Health
 
-		map[-1][-1] = "G"
+		map[-1][-1] = self.symbols.Goal
 
 		self.map = map
 #		return map
 
 
 	def _is_touching(self, dstate, obj):
-		i = 0
-		while True:
-			j = 0
-			while True:
-				if self.map[dstate[1]+j][dstate[0]+i] == obj:
-					return True
-				j += 1
-				if j == self.dsize:
-					break
-			i += 1
-			if i == self.dsize:
-				break
+		return (self.map[dstate[1]:dstate[1]+self.dsize, dstate[0]:dstate[0]+self.dsize] == obj).any()
 
-		return False
+	def _blocked_footprint(self):
+		return blocked_footprint(self.map, self.dsize)
 
-	def _is_map_good(self, start):
-		queue = collections.deque([[start]])
-		seen = set([start])
-#		print(self.map)
+	def _flood_fill(self, start):
+		"""
+		BFS from start over free droplet positions. Only a parent pointer per
+		position is kept (-1 when unreached), positions are flattened as y*cols+x.
+		Stops early once the goal position, whose footprint holds G, is reached.
+		"""
+		blocked = self._blocked_footprint()
+		rows, cols = blocked.shape
+		free = (~blocked).ravel().tolist()
+		goal = rows*cols - 1
+		parents = [-1] * (rows*cols)
+
+		first = start[1]*cols + start[0]
+		parents[first] = first
+		queue = collections.deque([first])
 		while queue:
-			path = queue.popleft()
-#			print(path)
-			x, y = path[-1]
-			if self._is_touching((x,y), self.symbols.Goal):
-				return True
-			for x2, y2 in ((x+1, y), (x-1, y), (x, y+1), (x, y-1)):
-				if 0 <= x2 < (self.w-self.dsize+1) and 0 <= y2 < (self.h-self.dsize+1) and \
-				(self._is_touching((x2,y2), self.symbols.Dynamic_module) == False) and\
-				(self._is_touching((x2,y2), self.symbols.Static_module) == False) and\
-				(x2, y2) not in seen:
-					queue.append(path + [(x2, y2)])
-					seen.add((x2, y2))
-#		print("Bad map")
-#		print(self.map)
-		return False
+			idx = queue.popleft()
+			if idx == goal:
+				break
+			y, x = divmod(idx, cols)
+			for n, ok in ((idx+1, x+1 < cols), (idx-1, x > 0), (idx+cols, y+1 < rows), (idx-cols, y > 0)):
+				if ok and free[n] and parents[n] == -1:
+					parents[n] = idx
+					queue.append(n)
+		return parents, cols
+
+	def _is_map_good(self, start):
+		parents, _ = self._flood_fill(start)
+		return parents[-1] != -1
+
+	def shortest_route(self, start=(0, 0)):
+		"""Shortest list of droplet positions from start to the goal on the current map, False if unreachable"""
+		parents, cols = self._flood_fill(start)
+		idx = len(parents) - 1
+		if parents[idx] == -1:
+			return False
+		path = []
+		while True:
+			y, x = divmod(idx, cols)
+			path.append((x, y))
+			if parents[idx] == idx:
+				break
+			idx = parents[idx]
+		return path[::-1]
 
 	def gen_random_map(self):
 		self._make_map()
+		self.n_attempts += 1
 		while self._is_map_good((0,0)) == False:
 			self._make_map()
+			self.n_attempts += 1
+		self.n_maps += 1
 		return self.map
+
+	def stats(self):
+		"""Rejection-loop statistics of gen_random_map so far"""
+		return {
+			"maps": self.n_maps,
+			"attempts": self.n_attempts,
+			"attempts_per_map": self.n_attempts / max(self.n_maps, 1),
+		}
 """
 if __name__ == '__main__':
 	mapclass = MakeMap(w=10,h=10,dsize=3,p=0.7)
@@ -0,0 +1,124 @@
+import os
+import struct
+import argparse
+import multiprocessing as mp
+import numpy as np
+
+from sub_envs.map import MakeMap
+
+# File layout: a fixed-size header followed by n_maps fixed-size records,
+# each record holding one int8 (h, w) board and optionally the number of
+# moves on its shortest route.
+MAGIC = b"MEDAMAPS"
+VERSION = 1
+HEADER = struct.Struct("<8sIIIIIdQ")
+HEADER_SIZE = 64
+CHUNK_SIZE = 10000
+
+def record_dtype(w, h, with_length):
+	fields = [("map", np.int8, (h, w))]
+	if with_length:
+		fields.append(("length", np.int32))
+	return np.dtype(fields)
+
+class MapBank():
+	"""
+	Read-only bank of pre-generated boards, memory-mapped so that resets are
+	O(1) and worker processes share the pages instead of copying the file.
+	"""
+	def __init__(self, path):
+		super(MapBank, self).__init__()
+		self.path = path
+		with open(path, "rb") as f:
+			magic, version, w, h, dsize, with_length, p, n_maps = HEADER.unpack(f.read(HEADER.size))
+		assert magic == MAGIC, "%s is not a map bank" % path
+		assert version == VERSION, "unsupported map bank version %d" % version
+		self.w = w
+		self.h = h
+		self.dsize = dsize
+		self.p = p
+		self.n_maps = n_maps
+		self.with_length = bool(with_length)
+		self.records = np.memmap(path, dtype=record_dtype(w, h, self.with_length), mode="r",
+			offset=HEADER_SIZE, shape=(n_maps,))
+
+	def __len__(self):
+		return self.n_maps
+
+	def __getitem__(self, idx):
+		# Envs move the droplet on their map, so always hand out a copy
+		return np.array(self.records[idx]["map"])
+
+	def length(self, idx):
+		assert self.with_length, "%s was generated without route lengths" % self.path
+		return int(self.records[idx]["length"])
+
+	def sample(self):
+		return self[np.random.randint(self.n_maps)]
+
+	def check(self, w, h, dsize):
+		assert (self.w, self.h, self.dsize) == (w, h, dsize), \
+			"map bank holds %dx%d dsize=%d boards" % (self.w, self.h, self.dsize)
+
+	# Reopen the file in child processes instead of pickling the mapped data
+	def __getstate__(self):
+		return {"path": self.path}
+
+	def __setstate__(self, state):
+		self.__init__(state["path"])
+
+
+def _gen_chunk(args):
+	w, h, dsize, p, with_length, seed, chunk_idx, n_maps = args
+	np.random.seed(np.random.SeedSequence([seed, chunk_idx]).generate_state(1)[0])
+	mapclass = MakeMap(w=w, h=h, dsize=dsize, p=p)
+	records = np.zeros(n_maps, dtype=record_dtype(w, h, with_length))
+	for i in range(n_maps):
+		records["map"][i] = mapclass.gen_random_map()
+		if with_length:
+			records["length"][i] = len(mapclass.shortest_route((0, 0))) - 1
+	return records, mapclass.stats()
+
+def build_bank(path, w, h, dsize, p, n_maps, with_length=False, seed=0, workers=1):
+	"""
+	Generate n_maps validated boards into path. Chunk i is always drawn from
+	seed (seed, i), so a bank is reproducible regardless of the worker count.
+	"""
+	with open(path, "wb") as f:
+		header = HEADER.pack(MAGIC, VERSION, w, h, dsize, int(with_length), p, n_maps)
+		f.write(header.ljust(HEADER_SIZE, b"\0"))
+		f.truncate(HEADER_SIZE + n_maps*record_dtype(w, h, with_length).itemsize)
+	records = np.memmap(path, dtype=record_dtype(w, h, with_length), mode="r+",
+		offset=HEADER_SIZE, shape=(n_maps,))
+
+	jobs = []
+	for chunk_idx, start in enumerate(range(0, n_maps, CHUNK_SIZE)):
+		jobs.append((w, h, dsize, p, with_length, seed, chunk_idx, min(CHUNK_SIZE, n_maps-start)))
+
+	n_done = 0
+	n_attempts = 0
+	with mp.Pool(workers) as pool:
+		for chunk, stats in pool.imap(_gen_chunk, jobs):
+			records[n_done:n_done+len(chunk)] = chunk
+			n_done += len(chunk)
+			n_attempts += stats["attempts"]
+			print("generated %d/%d maps, %.2f attempts per map" % (n_done, n_maps, n_attempts/n_done))
+	records.flush()
+	del records
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Generate a bank of validated MEDA boards")
+	parser.add_argument("-o", "--output", required=True, help="Bank file to write")
+	parser.add_argument("-n", "--num-maps", type=int, default=1000000, help="Number of boards")
+	parser.add_argument("--w", type=int, default=8)
+	parser.add_argument("--h", type=int, default=8)
+	parser.add_argument("--dsize", type=int, default=2)
+	parser.add_argument("-p", type=float, default=0.8, help="Probability of a healthy cell")
+	parser.add_argument("--lengths", default=False, action="store_true", help="Also store shortest route lengths")
+	parser.add_argument("--seed", type=int, default=0)
+	parser.add_argument("--workers", type=int, default=os.cpu_count())
+	args = parser.parse_args()
+
+	build_bank(args.output, args.w, args.h, args.dsize, args.p, args.num_maps,
+		with_length=args.lengths, seed=args.seed, workers=args.workers)
@@ -0,0 +1,38 @@
+import numpy as np
+
+# Observation encodings: "float" planes as float64 (the original), "uint8"
+# 0/1 planes and "packed", the planes flattened and bit-packed with
+# np.packbits into ceil(w*h*3/8) bytes per observation.
+OBS_MODES = ("float", "uint8", "packed")
+
+# Observation layouts: "whc" (w, h, 3), the original, or channels-first
+# "chw" (3, h, w), the planes as they are kept, contiguous for conv input.
+OBS_LAYOUTS = ("whc", "chw")
+N_PLANES = 3
+
+def obs_dtype(obs_mode):
+	assert obs_mode in OBS_MODES, "unknown observation mode %s" % obs_mode
+	return np.float64 if obs_mode == "float" else np.uint8
+
+def obs_shape(w, h, obs_layout):
+	assert obs_layout in OBS_LAYOUTS, "unknown observation layout %s" % obs_layout
+	return (N_PLANES, h, w) if obs_layout == "chw" else (w, h, N_PLANES)
+
+def layout_view(planes, obs_layout):
+	"""View of (..., 3, h, w) planes in obs_layout, without copying"""
+	if obs_layout == "chw":
+		return planes.view()
+	lead = tuple(range(planes.ndim - 3))
+	return planes.transpose(lead + (planes.ndim-1, planes.ndim-2, planes.ndim-3))
+
+def observation_space(obs_shape, obs_mode):
+	"""Shape of one observation as emitted in obs_mode"""
+	if obs_mode == "packed":
+		return ((int(np.prod(obs_shape)) + 7) // 8,)
+	return tuple(obs_shape)
+
+def pack_obs(obs, n_batch_dims=0):
+	"""Bit-pack 0/1 planes, keeping the leading n_batch_dims dimensions"""
+	obs = np.asarray(obs, dtype=np.uint8)
+	lead = obs.shape[:n_batch_dims]
+	return np.packbits(obs.reshape(lead + (-1,)), axis=-1)
@@ -0,0 +1,98 @@
+import collections
+import numpy as np
+
+from sub_envs.map import blocked_footprint
+from sub_envs.static import Actions
+
+# (dx, dy) per action, indexed by Actions
+MOVES = np.array([[0, -1], [1, 0], [0, 1], [-1, 0]])
+
+def distance_field(map, dsize):
+	"""
+	Moves from every droplet position to the goal position (the bottom right
+	one), -1 where the goal cannot be reached. Shape (h-dsize+1, w-dsize+1),
+	indexed [y, x]. The BFS runs from the goal as whole-board wavefronts.
+	"""
+	free = ~blocked_footprint(map, dsize)
+	dist = np.full(free.shape, -1, dtype=np.int32)
+	if not free[-1, -1]:
+		return dist
+	frontier = np.zeros_like(free)
+	frontier[-1, -1] = True
+	dist[-1, -1] = 0
+	d = 0
+	while frontier.any():
+		d += 1
+		reached = np.zeros_like(frontier)
+		reached[1:] |= frontier[:-1]
+		reached[:-1] |= frontier[1:]
+		reached[:, 1:] |= frontier[:, :-1]
+		reached[:, :-1] |= frontier[:, 1:]
+		reached &= free & (dist < 0)
+		dist[reached] = d
+		frontier = reached
+	return dist
+
+class PathOracle():
+	"""
+	Shortest-path answers for w x h boards and a dsize droplet. The distance
+	field of a board is computed once and kept in an LRU cache keyed by its
+	obstacle mask, so queries on a known board cost a hash and a lookup; the
+	field_* queries on a field already at hand are O(1).
+	"""
+	def __init__(self, w, h, dsize, cache_size=4096):
+		super(PathOracle, self).__init__()
+		assert cache_size > 0
+		self.w = w
+		self.h = h
+		self.dsize = dsize
+		self.cache_size = cache_size
+		self.cache = collections.OrderedDict()
+		self.n_hits = 0
+		self.n_misses = 0
+
+	def field(self, map):
+		"""Cached distance_field of map, read-only"""
+		# The droplet and goal cells do not change distances, only modules do
+		key = np.packbits(blocked_footprint(map, self.dsize)).tobytes()
+		field = self.cache.get(key)
+		if field is not None:
+			self.cache.move_to_end(key)
+			self.n_hits += 1
+			return field
+		self.n_misses += 1
+		field = distance_field(map, self.dsize)
+		field.flags.writeable = False
+		self.cache[key] = field
+		if len(self.cache) > self.cache_size:
+			self.cache.popitem(last=False)
+		return field
+
+	def distance(self, map, pos=(0, 0)):
+		"""Moves on the shortest route from pos (x, y) to the goal, -1 if unreachable"""
+		return self.field_distance(self.field(map), pos)
+
+	def reachable(self, map, pos=(0, 0)):
+		return self.distance(map, pos) >= 0
+
+	def is_optimal(self, map, pos, action):
+		"""Whether action from pos (x, y) lies on a shortest route to the goal"""
+		return self.field_is_optimal(self.field(map), pos, action)
+
+	def field_distance(self, field, pos):
+		return int(field[pos[1], pos[0]])
+
+	def field_is_optimal(self, field, pos, action):
+		dist = field[pos[1], pos[0]]
+		x, y = pos[0] + MOVES[action][0], pos[1] + MOVES[action][1]
+		if dist <= 0 or not (0 <= x < field.shape[1] and 0 <= y < field.shape[0]):
+			return False
+		return field[y, x] == dist - 1
+
+	def optimal_actions(self, map, pos):
+		field = self.field(map)
+		return [action for action in Actions if self.field_is_optimal(field, pos, action)]
+
+	def check(self, w, h, dsize):
+		assert (self.w, self.h, self.dsize) == (w, h, dsize), \
+			"path oracle answers for %dx%d dsize=%d boards" % (self.w, self.h, self.dsize)
@@ -0,0 +1,177 @@
+import functools
+import multiprocessing as mp
+from multiprocessing import shared_memory
+import numpy as np
+
+from sub_envs.static import Actions
+from sub_envs.vector import VectorMEDAEnv
+from sub_envs.obs import obs_shape, observation_space
+
+class SharedBatch():
+	"""
+	Observations, rewards and done flags of n_envs boards in one shared memory
+	block, indexed by env id. Float observations are stored as float32 so the
+	learner can wrap them with torch.from_numpy directly, compact uint8 ones
+	(see sub_envs.obs) as they are.
+	"""
+	def __init__(self, n_envs, obs_shape, name=None, obs_dtype=np.float32):
+		super(SharedBatch, self).__init__()
+		self.n_envs = n_envs
+		self.obs_shape = tuple(obs_shape)
+		self.obs_dtype = np.dtype(obs_dtype)
+		obs_bytes = n_envs * int(np.prod(self.obs_shape)) * self.obs_dtype.itemsize
+		# Keep the float64 rewards aligned after uint8 observations
+		self.obs_bytes = (obs_bytes + 7) // 8 * 8
+		size = self.obs_bytes + n_envs*8 + n_envs
+		if name is None:
+			self.shm = shared_memory.SharedMemory(create=True, size=size)
+		else:
+			self.shm = shared_memory.SharedMemory(name=name)
+		self.obs = np.ndarray((n_envs,) + self.obs_shape, dtype=self.obs_dtype, buffer=self.shm.buf)
+		self.rewards = np.ndarray((n_envs,), dtype=np.float64, buffer=self.shm.buf, offset=self.obs_bytes)
+		self.dones = np.ndarray((n_envs,), dtype=np.bool_, buffer=self.shm.buf, offset=self.obs_bytes + n_envs*8)
+
+	# Spawned workers attach to the block by name
+	def __getstate__(self):
+		return {"name": self.shm.name, "n_envs": self.n_envs, "obs_shape": self.obs_shape, "obs_dtype": self.obs_dtype.str}
+
+	def __setstate__(self, state):
+		self.__init__(state["n_envs"], state["obs_shape"], name=state["name"], obs_dtype=state["obs_dtype"])
+
+	def close(self, unlink=False):
+		# Views must go before the mapping can be closed
+		del self.obs, self.rewards, self.dones
+		self.shm.close()
+		if unlink:
+			self.shm.unlink()
+
+
+def _worker(remote, parent_remote, env_fn, seed, batch, ofs):
+	parent_remote.close()
+	# Forked workers inherit the parent's RNG state, give each its own stream
+	np.random.seed(seed)
+	env = env_fn()
+	if batch is not None:
+		slots = slice(ofs, ofs+env.n_envs)
+	try:
+		while True:
+			cmd, data = remote.recv()
+			if cmd == "step":
+				obs, rewards, dones, infos = env.step(data)
+				if batch is None:
+					remote.send((obs, rewards, dones, infos))
+				else:
+					batch.obs[slots] = obs
+					batch.rewards[slots] = rewards
+					batch.dones[slots] = dones
+					remote.send(infos)
+			elif cmd == "reset":
+				obs = env.reset()
+				if batch is None:
+					remote.send(obs)
+				else:
+					batch.obs[slots] = obs
+					remote.send(None)
+			elif cmd == "close":
+				break
+	except KeyboardInterrupt:
+		pass
+	finally:
+		env.close()
+		remote.close()
+		if batch is not None:
+			batch.close()
+
+class SubprocMEDAEnv():
+	"""
+	n_envs static boards split over n_workers processes, each stepping its share
+	as a VectorMEDAEnv. Same reset/step interface as VectorMEDAEnv, so it plugs
+	into common.VectorExperienceSourceFirstLast unchanged.
+
+	With shared_memory, workers write observations, rewards and dones into a
+	SharedBatch and only infos go through the pipes. step() then returns a copy
+	of the shared observations, or the shared array itself when copy_obs is
+	False, which is overwritten by the next step.
+	"""
+	def __init__(self, n_envs, n_workers, w=8, h=8, dsize=2, p=0.8, map_bank=None, prefetcher=None, seed=None,
+			shared_memory=True, copy_obs=True, oracle=None, obs_mode="float", obs_layout="whc"):
+		super(SubprocMEDAEnv, self).__init__()
+		assert 0 < n_workers <= n_envs
+		self.n_envs = n_envs
+		self.n_workers = n_workers
+		self.sizes = [len(chunk) for chunk in np.array_split(np.arange(n_envs), n_workers)]
+		if seed is None:
+			seed = np.random.SeedSequence().entropy
+		self.copy_obs = copy_obs
+		self.obs_shape = obs_shape(w, h, obs_layout)
+		self.obs_mode = obs_mode
+		self.obs_layout = obs_layout
+		self.observation_space = observation_space(self.obs_shape, obs_mode)
+		if shared_memory:
+			self.batch = SharedBatch(n_envs, self.observation_space, obs_dtype=np.float32 if obs_mode == "float" else np.uint8)
+		else:
+			self.batch = None
+
+		self.remotes = []
+		self.processes = []
+		ofs = 0
+		for idx, size in enumerate(self.sizes):
+			env_fn = functools.partial(VectorMEDAEnv, n_envs=size, w=w, h=h, dsize=dsize, p=p, map_bank=map_bank, prefetcher=prefetcher, oracle=oracle, obs_mode=obs_mode, obs_layout=obs_layout)
+			worker_seed = np.random.SeedSequence([seed, idx]).generate_state(1)[0]
+			remote, work_remote = mp.Pipe()
+			proc = mp.Process(target=_worker, args=(work_remote, remote, env_fn, worker_seed, self.batch, ofs), daemon=True)
+			proc.start()
+			work_remote.close()
+			self.remotes.append(remote)
+			self.processes.append(proc)
+			ofs += size
+
+		self.actions = Actions
+		self.action_space = len(self.actions)
+		self.closed = False
+
+	def reset(self):
+		for remote in self.remotes:
+			remote.send(("reset", None))
+		obs = [remote.recv() for remote in self.remotes]
+		if self.batch is None:
+			return np.concatenate(obs)
+		return self._shared_obs()
+
+	def step(self, actions):
+		actions = np.asarray(actions)
+		ofs = 0
+		for remote, size in zip(self.remotes, self.sizes):
+			remote.send(("step", actions[ofs:ofs+size]))
+			ofs += size
+
+		if self.batch is not None:
+			infos = []
+			for remote in self.remotes:
+				infos.extend(remote.recv())
+			return self._shared_obs(), self.batch.rewards.copy(), self.batch.dones.copy(), infos
+
+		obs, rewards, dones, infos = [], [], [], []
+		for remote in self.remotes:
+			o, r, d, i = remote.recv()
+			obs.append(o)
+			rewards.append(r)
+			dones.append(d)
+			infos.extend(i)
+		return np.concatenate(obs), np.concatenate(rewards), np.concatenate(dones), infos
+
+	def _shared_obs(self):
+		if self.copy_obs:
+			return self.batch.obs.copy()
+		return self.batch.obs
+
+	def close(self):
+		if self.closed:
+			return
+		for remote in self.remotes:
+			remote.send(("close", None))
+		for proc in self.processes:
+			proc.join()
+		if self.batch is not None:
+			self.batch.close(unlink=True)
+		self.closed = True
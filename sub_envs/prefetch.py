@@ -0,0 +1,88 @@
+import multiprocessing as mp
+import numpy as np
+
+from sub_envs.map import MakeMap
+
+def _produce(w, h, dsize, p, seed, boards, head, tail, lock, empty, full, stop):
+	np.random.seed(seed)
+	mapclass = MakeMap(w=w, h=h, dsize=dsize, p=p)
+	ring = np.frombuffer(boards, dtype=np.int8).reshape(-1, h, w)
+	while not stop.is_set():
+		map = mapclass.gen_random_map()
+		# Wait for a free slot, but keep an eye on the stop flag
+		while not empty.acquire(timeout=0.1):
+			if stop.is_set():
+				return
+		with lock:
+			ring[tail.value] = map
+			tail.value = (tail.value + 1) % len(ring)
+		full.release()
+
+class MapPrefetcher():
+	"""
+	Runs MakeMap in background processes that push finished boards into a
+	bounded ring in shared memory. get() never blocks: it returns None when the
+	ring is empty and the caller falls back to generating the board itself.
+	"""
+	def __init__(self, w, h, dsize, p, capacity=256, workers=1, seed=None):
+		super(MapPrefetcher, self).__init__()
+		assert capacity > 0 and workers > 0
+		self.w = w
+		self.h = h
+		self.dsize = dsize
+		self.p = p
+		self.capacity = capacity
+		self.workers = workers
+		self.seed = seed if seed is not None else np.random.SeedSequence().entropy
+
+		self.boards = mp.RawArray("b", capacity*h*w)
+		self.ring = np.frombuffer(self.boards, dtype=np.int8).reshape(capacity, h, w)
+		self.head = mp.RawValue("i", 0)
+		self.tail = mp.RawValue("i", 0)
+		self.lock = mp.Lock()
+		self.empty = mp.Semaphore(capacity)
+		self.full = mp.Semaphore(0)
+		self.stop = mp.Event()
+		self.processes = []
+
+		# Boards served from the ring and resets that had to generate their own
+		self.n_hits = 0
+		self.n_misses = 0
+
+	def start(self):
+		for idx in range(self.workers):
+			seed = np.random.SeedSequence([self.seed, idx]).generate_state(1)[0]
+			proc = mp.Process(target=_produce, daemon=True, args=(self.w, self.h, self.dsize, self.p, seed,
+				self.boards, self.head, self.tail, self.lock, self.empty, self.full, self.stop))
+			proc.start()
+			self.processes.append(proc)
+		return self
+
+	def get(self):
+		if not self.full.acquire(block=False):
+			self.n_misses += 1
+			return None
+		with self.lock:
+			map = self.ring[self.head.value].copy()
+			self.head.value = (self.head.value + 1) % self.capacity
+		self.empty.release()
+		self.n_hits += 1
+		return map
+
+	def check(self, w, h, dsize):
+		assert (self.w, self.h, self.dsize) == (w, h, dsize), \
+			"map prefetcher makes %dx%d dsize=%d boards" % (self.w, self.h, self.dsize)
+
+	def close(self):
+		self.stop.set()
+		for proc in self.processes:
+			proc.join(timeout=1.0)
+			if proc.is_alive():
+				proc.terminate()
+		self.processes = []
+
+	def __enter__(self):
+		return self.start()
+
+	def __exit__(self, *args):
+		self.close()
@@ -8,7 +8,9 @@ import collections
 import gym
 
 from sub_envs.map import MakeMap
-from sub_envs.map import Symbols
+from sub_envs.map import Codes
+from sub_envs.map import encode_map
+from sub_envs.obs import obs_dtype, obs_shape, observation_space, layout_view, pack_obs
 
 class Actions(IntEnum):
 	N = 0
@@ -17,7 +19,7 @@ class Actions(IntEnum):
 	W = 3
 
 class MEDAEnv(gym.Env):
-	def __init__(self, w=8, h=8, dsize=2, p=0.8, test_flag=False):
+	def __init__(self, w=8, h=8, dsize=2, p=0.8, test_flag=False, copy_obs=True, map_bank=None, prefetcher=None, oracle=None, obs_mode="float", obs_layout="whc"):
 		super(MEDAEnv, self).__init__()
 		assert w>0 and h>0 and dsize>0
 		assert 0<=p<=1.0
@@ -27,41 +29,80 @@ class MEDAEnv(gym.Env):
 		self.p = p
 		self.actions = Actions
 		self.action_space = len(self.actions)
-		self.observation_space = (w, h, 3)
+		self.obs_shape = obs_shape(w, h, obs_layout)
+		self.obs_mode = obs_mode
+		self.obs_layout = obs_layout
+		self.observation_space = observation_space(self.obs_shape, obs_mode)
 		self.n_steps = 0
 		self.max_step = 2*(w+h)
 
 		self.state = (0,0)
 		self.goal = (w-1, h-1)
 
-		self.map_symbols = Symbols()
+		self.map_symbols = Codes()
 		self.mapclass = MakeMap(w=self.w,h=self.h,dsize=self.dsize,p=self.p)
-		self.map = self.mapclass.gen_random_map()
+		# Boards are sampled from a pre-generated MapBank when one is given,
+		# otherwise taken from a MapPrefetcher if it has one ready
+		self.map_bank = map_bank
+		if self.map_bank is not None:
+			self.map_bank.check(w, h, dsize)
+		self.prefetcher = prefetcher
+		if self.prefetcher is not None:
+			self.prefetcher.check(w, h, dsize)
+		# With a PathOracle, progress is rewarded along the shortest route
+		# around the modules instead of by straight-line distance
+		self.oracle = oracle
+		if self.oracle is not None:
+			self.oracle.check(w, h, dsize)
+		self.map = self._gen_random_map()
+		self._set_field()
 
 		self.test_flag = test_flag
 
+		# step() returns a copy of the observation buffer, or a read-only view
+		# of it that changes on the next step when copy_obs is False
+		self.copy_obs = copy_obs
+		# Planes are kept (3, h, w) like the map, obs is their view in obs_layout
+		self.planes = np.zeros((3, h, w), dtype=obs_dtype(obs_mode))
+		self.obs = layout_view(self.planes, obs_layout)
+		self.obs.flags.writeable = False
+		self._set_planes(self.planes, self.map)
+
 	def reset(self, test_map=None):
 		self.n_steps = 0
 		self.state = (0, 0)
 
 		if self.test_flag == False:
-			self.map = self.mapclass.gen_random_map()
+			self.map = self._gen_random_map()
 		else:
-			self.map = test_map
+			self.map = encode_map(test_map)
+		self._set_field()
+		self._set_planes(self.planes, self.map)
 
 		obs = self._get_obs()
 
 		return obs
 
+	def _gen_random_map(self):
+		if self.map_bank is not None:
+			return self.map_bank.sample()
+		if self.prefetcher is not None:
+			map = self.prefetcher.get()
+			if map is not None:
+				return map
+		return self.mapclass.gen_random_map()
+
 	def step(self, action):
 		done = False
 		self.n_steps += 1
 		message = None
 
 		_dist = self._get_dist(self.state, self.goal)
+		_route_dist = self._get_route_dist(self.state)
 #		print(_dist)
 		self._update_position(action)
 		dist = self._get_dist(self.state, self.goal)
+		route_dist = self._get_route_dist(self.state)
 #		print(self.map)
 
 		if dist <= (self.dsize-1)*math.sqrt(2):
@@ -71,9 +112,9 @@ class MEDAEnv(gym.Env):
 		elif self.n_steps == self.max_step:
 			reward = -0.8
 			done = True
-		elif dist < _dist:
+		elif route_dist < _route_dist:
 			reward = 0.5
-		elif dist == _dist:
+		elif route_dist == _route_dist:
 			reward = -0.5
 		else:
 			reward = -0.8
@@ -91,21 +132,20 @@ class MEDAEnv(gym.Env):
 		diff_y = state1[0] - state2[0]
 		return math.sqrt(diff_x*diff_x + diff_y*diff_y)
 
+	def _set_field(self):
+		if self.oracle is not None:
+			self.field = self.oracle.field(self.map)
+
+	def _get_route_dist(self, state):
+		if self.oracle is None:
+			return self._get_dist(state, self.goal)
+		return self.field[state[1], state[0]]
+
+	def _footprint(self, dstate):
+		return self.map[dstate[1]:dstate[1]+self.dsize, dstate[0]:dstate[0]+self.dsize]
+
 	def _is_touching(self, dstate, obj):
-		i = 0
-		while True:
-			j = 0
-			while True:
-				if self.map[dstate[1]+j][dstate[0]+i] == obj:
-					return True
-				j += 1
-				if j == self.dsize:
-					break
-			i += 1
-			if i == self.dsize:
-				break
-
-		return False
+		return (self._footprint(dstate) == obj).any()
 
 	def _update_position(self, action):
 		state_ = list(self.state)
@@ -121,46 +161,34 @@ class MEDAEnv(gym.Env):
 
 		if (0 <= state_[1] < self.h-self.dsize+1) and (0 <= state_[0] < self.w-self.dsize+1) and\
 		   (self._is_touching(state_, self.map_symbols.Dynamic_module) == False) and (self._is_touching(state_, self.map_symbols.Static_module) == False):
-			i = 0
-			while True:
-				j = 0
-				while True:
-					self.map[self.state[1]+j][self.state[0]+i] = self.map_symbols.Health
-					j += 1
-					if j == self.dsize:
-						break
-				i += 1
-				if i == self.dsize:
-					break
+			_state = self.state
+			self._footprint(self.state)[:] = self.map_symbols.Health
 
 			self.state = state_
 
 			# Set Droplet state
-			i = 0
-			while True:
-				j = 0
-				while True:
-					self.map[self.state[1]+j][self.state[0]+i] = self.map_symbols.State
-					j += 1
-					if j == self.dsize:
-						break
-				i += 1
-				if i == self.dsize:
-					break
+			self._footprint(self.state)[:] = self.map_symbols.State
 
+			# Only the cells the droplet left and entered change
+			self._refresh_obs(_state)
+			self._refresh_obs(self.state)
+
+
+	def _set_planes(self, planes, map):
+		planes[0] = map == self.map_symbols.State
+		planes[1] = map == self.map_symbols.Goal
+		planes[2] = (map == self.map_symbols.Dynamic_module) | (map == self.map_symbols.Static_module)
+
+	def _refresh_obs(self, dstate):
+		planes = self.planes[:, dstate[1]:dstate[1]+self.dsize, dstate[0]:dstate[0]+self.dsize]
+		self._set_planes(planes, self._footprint(dstate))
 
 	def _get_obs(self):
-		obs = np.zeros(shape = (self.w, self.h, 3))
-		for i in range(self.w):
-			for j in range(self.h):
-				if self.map[j][i] == self.map_symbols.State:
-					obs[i][j][0] = 1
-				elif self.map[j][i] == self.map_symbols.Goal:
-					obs[i][j][1] = 1
-				elif self.map[j][i] == self.map_symbols.Dynamic_module or self.map[j][i] == self.map_symbols.Static_module:
-					obs[i][j][2] = 1
-#		print(obs)
-		return obs
+		if self.obs_mode == "packed":
+			return pack_obs(self.obs)
+		if self.copy_obs:
+			return self.obs.copy()
+		return self.obs
 
 	def close(self):
 		pass
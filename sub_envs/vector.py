@@ -0,0 +1,166 @@
+import numpy as np
+import math
+
+from sub_envs.map import MakeMap
+from sub_envs.map import Codes
+from sub_envs.static import Actions
+from sub_envs.obs import obs_dtype, obs_shape, observation_space, pack_obs
+
+HEALTH = Codes.Health
+STATE = Codes.State
+GOAL = Codes.Goal
+STATIC_MODULE = Codes.Static_module
+DYNAMIC_MODULE = Codes.Dynamic_module
+
+class VectorMEDAEnv():
+	"""
+	N static MEDA boards stepped together as one (N, h, w) int8 tensor.
+	step() takes N actions and returns batched obs, rewards and dones,
+	finished boards are reset automatically unless auto_reset is False.
+	"""
+	def __init__(self, n_envs, w=8, h=8, dsize=2, p=0.8, map_bank=None, prefetcher=None, auto_reset=True, oracle=None, obs_mode="float", obs_layout="whc"):
+		super(VectorMEDAEnv, self).__init__()
+		assert n_envs>0
+		assert w>0 and h>0 and dsize>0
+		assert 0<=p<=1.0
+		self.n_envs = n_envs
+		self.w = w
+		self.h = h
+		self.dsize = dsize
+		self.p = p
+		self.auto_reset = auto_reset
+		self.actions = Actions
+		self.action_space = len(self.actions)
+		self.obs_shape = obs_shape(w, h, obs_layout)
+		self.obs_mode = obs_mode
+		self.obs_layout = obs_layout
+		self.obs_dtype = obs_dtype(obs_mode)
+		self.observation_space = observation_space(self.obs_shape, obs_mode)
+		self.max_step = 2*(w+h)
+		self.goal_dist = (dsize-1)*math.sqrt(2)
+
+		self.mapclass = MakeMap(w=self.w,h=self.h,dsize=self.dsize,p=self.p)
+		self.map_bank = map_bank
+		if self.map_bank is not None:
+			self.map_bank.check(w, h, dsize)
+		self.prefetcher = prefetcher
+		if self.prefetcher is not None:
+			self.prefetcher.check(w, h, dsize)
+
+		# Progress is measured along shortest routes when a PathOracle is given
+		self.oracle = oracle
+		if self.oracle is not None:
+			self.oracle.check(w, h, dsize)
+			self.fields = np.zeros((n_envs, h-dsize+1, w-dsize+1), dtype=np.int32)
+
+		self.maps = np.zeros((n_envs, h, w), dtype=np.int8)
+		self.states = np.zeros((n_envs, 2), dtype=np.int64)
+		self.n_steps = np.zeros(n_envs, dtype=np.int64)
+		self.goal = np.array([w-1, h-1])
+
+		# (dx, dy) per action, indexed by Actions
+		self._moves = np.array([[0, -1], [1, 0], [0, 1], [-1, 0]])
+		self._limit = np.array([w-dsize, h-dsize])
+		dy, dx = np.meshgrid(np.arange(dsize), np.arange(dsize), indexing="ij")
+		self._dx = dx.ravel()
+		self._dy = dy.ravel()
+		self._env_idx = np.arange(n_envs)[:, None]
+
+		for idx in range(n_envs):
+			self._reset_env(idx)
+
+	def reset(self, maps=None):
+		"""Start all boards over, on the given (N, h, w) boards when maps is set"""
+		for idx in range(self.n_envs):
+			self._reset_env(idx, None if maps is None else maps[idx])
+		return self._get_obs()
+
+	def step(self, actions):
+		actions = np.asarray(actions, dtype=np.int64)
+		self.n_steps += 1
+
+		_route_dist = self._get_route_dist(self.states)
+		self._update_position(actions)
+		dist = self._get_dist(self.states)
+		route_dist = self._get_route_dist(self.states)
+
+		rewards = np.where(route_dist < _route_dist, 0.5, np.where(route_dist == _route_dist, -0.5, -0.8))
+		timeout = self.n_steps == self.max_step
+		rewards[timeout] = -0.8
+		goal = dist <= self.goal_dist
+		rewards[goal] = 1.0
+		dones = goal | timeout
+
+		if self.auto_reset:
+			for idx in np.nonzero(dones)[0]:
+				self._reset_env(idx)
+
+		obs = self._get_obs()
+		return obs, rewards, dones, [None]*self.n_envs
+
+	def _reset_env(self, idx, map=None):
+		self.maps[idx] = self._gen_random_map() if map is None else map
+		self.states[idx] = 0
+		self.n_steps[idx] = 0
+		if self.oracle is not None:
+			self.fields[idx] = self.oracle.field(self.maps[idx])
+
+	def _gen_random_map(self):
+		if self.map_bank is not None:
+			return self.map_bank.sample()
+		if self.prefetcher is not None:
+			map = self.prefetcher.get()
+			if map is not None:
+				return map
+		return self.mapclass.gen_random_map()
+
+	def _get_dist(self, states):
+		diff = states - self.goal
+		return np.sqrt((diff*diff).sum(axis=1))
+
+	def _get_route_dist(self, states):
+		if self.oracle is None:
+			return self._get_dist(states)
+		return self.fields[self._env_idx[:, 0], states[:, 1], states[:, 0]]
+
+	def _footprint(self, states):
+		return states[:, 1, None] + self._dy, states[:, 0, None] + self._dx
+
+	def _update_position(self, actions):
+		states_ = self.states + self._moves[actions]
+		inside = ((states_ >= 0) & (states_ <= self._limit)).all(axis=1)
+
+		# Clip so that the footprint lookup stays on the board, then reject by inside
+		ys, xs = self._footprint(np.clip(states_, 0, self._limit))
+		cells = self.maps[self._env_idx, ys, xs]
+		blocked = ((cells == STATIC_MODULE) | (cells == DYNAMIC_MODULE)).any(axis=1)
+
+		moved = np.nonzero(inside & ~blocked)[0]
+		if len(moved) == 0:
+			return
+
+		env_idx = self._env_idx[moved]
+		ys, xs = self._footprint(self.states[moved])
+		self.maps[env_idx, ys, xs] = HEALTH
+		self.states[moved] = states_[moved]
+		ys, xs = self._footprint(self.states[moved])
+		self.maps[env_idx, ys, xs] = STATE
+
+	def _get_obs(self):
+		obs = np.zeros((self.n_envs,) + self.obs_shape, dtype=self.obs_dtype)
+		if self.obs_layout == "chw":
+			maps = self.maps
+			obs[:, 0] = maps == STATE
+			obs[:, 1] = maps == GOAL
+			obs[:, 2] = (maps == STATIC_MODULE) | (maps == DYNAMIC_MODULE)
+		else:
+			maps = self.maps.transpose(0, 2, 1)
+			obs[..., 0] = maps == STATE
+			obs[..., 1] = maps == GOAL
+			obs[..., 2] = (maps == STATIC_MODULE) | (maps == DYNAMIC_MODULE)
+		if self.obs_mode == "packed":
+			return pack_obs(obs, n_batch_dims=1)
+		return obs
+
+	def close(self):
+		pass
@@ -1,53 +1,121 @@
+import os
+import functools
+import multiprocessing as mp
 import torch as T
-from train import AtariA2C
+from train import AtariA2C, FCA2C
 import ptan
-from sub_envs.static import MEDAEnv
-#from envs.dynamic import MEDAEnv
+from sub_envs.static import Actions
+from sub_envs.dynamic import MEDAEnv as DynamicMEDAEnv
+from sub_envs.vector import VectorMEDAEnv
 import numpy as np
-import collections
 
 
 from sub_envs.map import MakeMap
-from sub_envs.map import Symbols
+from sub_envs.map_bank import MapBank
+from sub_envs.oracle import distance_field
+from sub_envs.obs import obs_shape
 
 #from tensorboardX import SummaryWriter
 
-def _is_touching(dstate, obj, map, dsize):
-		i = 0
-		while True:
-			j = 0
-			while True:
-				if map[dstate[1]+j][dstate[0]+i] == obj:
-					return True
-				j += 1
-				if j == dsize:
-					break
-			i += 1
-			if i == dsize:
-				break
-
-		return False
-
-def _compute_shortest_route(w, h, dsize, symbols,map, start):
-	queue = collections.deque([[start]])
-	seen = set([start])
-#		print(self.map)
-	while queue:
-		path = queue.popleft()
-#			print(path)
-		x, y = path[-1]
-		if _is_touching((x,y), symbols.Goal, map, dsize):
-			return path
-		for x2, y2 in ((x+1, y), (x-1, y), (x, y+1), (x, y-1)):
-			if 0 <= x2 < (w-dsize+1) and 0 <= y2 < (h-dsize+1) and \
-			(_is_touching((x2,y2), symbols.Dynamic_module, map, dsize) == False) and\
-			(_is_touching((x2,y2), symbols.Static_module, map, dsize) == False) and\
-			(x2, y2) not in seen:
-				queue.append(path + [(x2, y2)])
-				seen.add((x2, y2))
-#		print("Bad map")
-#		print(self.map)
-	return False
+def _route_len(dsize, map):
+	# Test maps rarely repeat, so the field is not worth caching
+	return distance_field(map, dsize)[0, 0]
+
+def route_lengths(maps, dsize, workers):
+	"""Shortest route lengths in moves of all maps, computed by a process pool"""
+	with mp.Pool(workers) as pool:
+		lengths = pool.map(functools.partial(_route_len, dsize), maps, chunksize=max(1, len(maps)//(4*workers)))
+	return np.array(lengths)
+
+def evaluate(policy, maps, w, h, dsize, device="cpu", obs_layout="whc"):
+	"""
+	Play every map once, greedily and in lockstep: each step runs one forward
+	over the games still going and steps all boards together.
+	:return: steps taken and whether the goal was reached, per map
+	"""
+	n_games = len(maps)
+	env = VectorMEDAEnv(n_envs=n_games, w=w, h=h, dsize=dsize, auto_reset=False, obs_layout=obs_layout)
+	observation = env.reset(maps=maps)
+	actions = np.zeros(n_games, dtype=np.int64)
+	n_steps = np.zeros(n_games, dtype=np.int64)
+	success = np.zeros(n_games, dtype=bool)
+	active = np.ones(n_games, dtype=bool)
+
+	while active.any():
+		idx = np.nonzero(active)[0]
+		with T.no_grad():
+			probs = policy(T.from_numpy(observation[idx]).to(device))
+		actions[idx] = T.argmax(probs, dim=1).cpu().numpy()
+
+		# Finished boards keep moving with stale actions, their results are kept
+		observation, reward, done, _ = env.step(actions)
+		finished = idx[done[idx]]
+		n_steps[finished] = env.n_steps[finished]
+		success[finished] = reward[finished] == 1.0
+		active[finished] = False
+
+	return n_steps, success
+
+
+def evaluate_dynamic(policy, maps, w, h, dsize, device="cpu", obs_layout="whc"):
+	"""
+	evaluate() on the dynamic env, whose boards are stepped one by one (there
+	is no vector dynamic env). Steps hitting a dynamic module report
+	"derror"; like the original harness they are counted apart from n_steps.
+	:return: steps taken without derror, whether the goal was reached and derrors, per map
+	"""
+	n_games = len(maps)
+	envs = [DynamicMEDAEnv(w=w, h=h, dsize=dsize, test_flag=True, obs_layout=obs_layout) for _ in range(n_games)]
+	# The env plays on the int8 board it is given, dynamic modules hit turn static
+	observation = np.array([env.reset(test_map=map.copy()) for env, map in zip(envs, maps)])
+	n_steps = np.zeros(n_games, dtype=np.int64)
+	derrors = np.zeros(n_games, dtype=np.int64)
+	success = np.zeros(n_games, dtype=bool)
+	active = np.ones(n_games, dtype=bool)
+
+	while active.any():
+		idx = np.nonzero(active)[0]
+		with T.no_grad():
+			probs = policy(T.from_numpy(observation[idx]).to(device))
+		actions = T.argmax(probs, dim=1).cpu().numpy()
+
+		for i, action in zip(idx, actions):
+			observation[i], reward, done, message = envs[i].step(action)
+			if message == "derror":
+				derrors[i] += 1
+			else:
+				n_steps[i] += 1
+			if done:
+				success[i] = reward == 1.0
+				active[i] = False
+
+	return n_steps, success, derrors
+
+
+def route_stats(route_len, n_steps):
+	""":return: number of games on a shortest route and extra moves over it, per game"""
+	return int((route_len == n_steps).sum()), n_steps - route_len
+
+def report(total_games, route_len, n_steps, success, derrors=None):
+	n_critical, extra_steps = route_stats(route_len, n_steps)
+
+	print("Finish " + str(total_games) + " tests")
+	print("Num of critical path is ", n_critical)
+	print("Avg of critical path is ", n_critical/total_games)
+	print("Num of goals reached is ", int(success.sum()))
+	print("Steps histogram (steps: games)")
+	for steps, count in enumerate(np.bincount(n_steps)):
+		if count:
+			print("  %d: %d" % (steps, count))
+	print("Extra steps over shortest route of reached goals (extra steps: games)")
+	for value, count in zip(*np.unique(extra_steps[success], return_counts=True)):
+		print("  %d: %d" % (value, count))
+	if derrors is not None:
+		print("Num of derror is ", int(derrors.sum()))
+		print("Derror histogram (derrors: games)")
+		for value, count in enumerate(np.bincount(derrors)):
+			if count:
+				print("  %d: %d" % (value, count))
 
 
 if __name__ == "__main__":
@@ -60,56 +128,61 @@ if __name__ == "__main__":
 	DSIZE = 2
 	P = 0.8
 
-	############################
-	env = MEDAEnv(w=W, h=H, dsize=DSIZE, p=P, test_flag=True)
+	MAP_BANK = None		#MapBank file to evaluate on, random maps are generated when None
+	INFERENCE = "script"	#eager, script, trace or compile
+	ENV = "static"	#static, or dynamic to also count derror steps (boards stepped one by one)
+	OBS_LAYOUT = "whc"	#Observation layout the checkpoint was trained with
+	NET = "atari"	#atari, or fc for an FCA2C checkpoint (chw)
+	TEST_SIZES = [(W, H)]	#(w, h) boards to test, one batch per size, more than one needs NET = "fc"
+	EVAL_BATCH = 1000	#Games played together
+	ORACLE_WORKERS = os.cpu_count()	#Processes computing shortest routes
 
+	############################
 	device = T.device('cpu')
 
 #	writer = SummaryWriter(comment = "Result of " + ENV_NAME)
 	CHECKPOINT_PATH = "saves/" + ENV_NAME
 
-	net = AtariA2C(env.observation_space, env.action_space).to(device)
-	net.load_checkpoint(CHECKPOINT_PATH)
-
-	n_games = 0
-
-	n_critical = 0
-
-	map_symbols = Symbols()
-	mapclass = MakeMap(w=W,h=H,dsize=DSIZE,p=P)
-
-	while n_games != TOTAL_GAMES:
-		done = False
-		score = 0
-		n_steps = 0
-		map = mapclass.gen_random_map()
-		observation = env.reset(test_map=map)
-
-		path = _compute_shortest_route(W, H, DSIZE, map_symbols, map, (0,0))
-
-		while not done:
-			observation = T.tensor([observation], dtype=T.float).to(device)
-			probs, _ = net(observation)
-			action = T.argmax(probs).item()
-		
-			observation_, reward, done, message = env.step(action)
-
-			score += reward
-			observation = observation_
-
-			if message == None:
-				n_steps += 1
-
-#		print("shortest:",len(path))
-#		print("stepnum:",n_steps)
-
-		if len(path) == n_steps:
-			n_critical += 1
-
-#		writer.add_scalar("Step_num", n_steps, n_games)
-		n_games += 1
-
-	print("Finish " + str(TOTAL_GAMES) + " tests")
-	print("Num of critical path is ", n_critical)
-	print("Avg of critical path is ", n_critical/TOTAL_GAMES)
-
+	if NET == "fc":
+		OBS_LAYOUT = "chw"
+		net = FCA2C(len(Actions)).to(device)
+	else:
+		net = AtariA2C(obs_shape(W, H, OBS_LAYOUT), len(Actions), obs_layout=OBS_LAYOUT).to(device)
+	policy = net.load_checkpoint(CHECKPOINT_PATH, inference=INFERENCE, policy_only=True)
+
+	for w, h in TEST_SIZES:
+		mapclass = MakeMap(w=w,h=h,dsize=DSIZE,p=P)
+		total_games = TOTAL_GAMES
+
+		if MAP_BANK is not None:
+			bank = MapBank(MAP_BANK)
+			bank.check(w, h, DSIZE)
+			total_games = min(total_games, len(bank))
+			maps = np.array(bank.records["map"][:total_games])
+		else:
+			maps = np.array([mapclass.gen_random_map() for _ in range(total_games)])
+
+		# Route length counts moves, like n_steps
+		if MAP_BANK is not None and bank.with_length:
+			route_len = np.array(bank.records["length"][:total_games])
+		else:
+			route_len = route_lengths(maps, DSIZE, ORACLE_WORKERS)
+
+		n_steps = []
+		success = []
+		derrors = []
+		for start in range(0, total_games, EVAL_BATCH):
+			if ENV == "dynamic":
+				steps, ok, derror = evaluate_dynamic(policy, maps[start:start+EVAL_BATCH], w, h, DSIZE, device, OBS_LAYOUT)
+				derrors.append(derror)
+			else:
+				steps, ok = evaluate(policy, maps[start:start+EVAL_BATCH], w, h, DSIZE, device, OBS_LAYOUT)
+			n_steps.append(steps)
+			success.append(ok)
+		n_steps = np.concatenate(n_steps)
+		success = np.concatenate(success)
+		derrors = np.concatenate(derrors) if derrors else None
+
+		if len(TEST_SIZES) > 1:
+			print("Board %dx%d" % (w, h))
+		report(total_games, route_len, n_steps, success, derrors)
@@ -0,0 +1,33 @@
+import numpy as np
+import torch as T
+import pytest
+
+from sub_envs.map import MakeMap, Codes
+from sub_envs.oracle import distance_field
+from sub_envs.expert import expert_actions
+from test import evaluate, route_stats, _route_len
+
+def _oracle_policy(dsize):
+	"""Shortest-route policy on whc observations, the board is read back from the planes"""
+	def policy(obs):
+		planes = obs.numpy().transpose(0, 3, 2, 1)
+		maps = np.where(planes[:, 2] > 0, Codes.Static_module, Codes.Health).astype(np.int8)
+		maps[planes[:, 1] > 0] = Codes.Goal
+		fields = np.array([distance_field(map, dsize) for map in maps])
+		states = np.array([np.argwhere(state > 0).min(axis=0)[::-1] for state in planes[:, 0]])
+		probs = np.zeros((len(obs), 4), dtype=np.float32)
+		probs[np.arange(len(obs)), expert_actions(fields, states)] = 1.0
+		return T.from_numpy(probs)
+	return policy
+
+@pytest.mark.parametrize("w,h,dsize,p", [(8, 8, 1, 0.8), (8, 8, 2, 0.8), (12, 10, 2, 0.8)])
+def test_optimal_games_have_no_extra_steps(w, h, dsize, p):
+	np.random.seed(dsize)
+	mapclass = MakeMap(w=w, h=h, dsize=dsize, p=p)
+	maps = np.array([mapclass.gen_random_map() for _ in range(20)])
+	route_len = np.array([_route_len(dsize, map) for map in maps])
+	n_steps, success = evaluate(_oracle_policy(dsize), maps, w, h, dsize)
+	assert success.all()
+	n_critical, extra_steps = route_stats(route_len, n_steps)
+	assert n_critical == len(maps)
+	assert (extra_steps == 0).all()
@@ -0,0 +1,81 @@
+import collections
+import numpy as np
+import pytest
+
+from sub_envs.map import MakeMap, Symbols, decode_map
+from sub_envs.oracle import distance_field, PathOracle
+
+# The shortest route search test.py used before the oracle, on string boards
+
+def _is_touching(dstate, obj, map, dsize):
+	for i in range(dsize):
+		for j in range(dsize):
+			if map[dstate[1]+j][dstate[0]+i] == obj:
+				return True
+	return False
+
+def _compute_shortest_route(w, h, dsize, symbols, map, start):
+	queue = collections.deque([[start]])
+	seen = set([start])
+	while queue:
+		path = queue.popleft()
+		x, y = path[-1]
+		if _is_touching((x, y), symbols.Goal, map, dsize):
+			return path
+		for x2, y2 in ((x+1, y), (x-1, y), (x, y+1), (x, y-1)):
+			if 0 <= x2 < (w-dsize+1) and 0 <= y2 < (h-dsize+1) and \
+			(_is_touching((x2, y2), symbols.Dynamic_module, map, dsize) == False) and \
+			(_is_touching((x2, y2), symbols.Static_module, map, dsize) == False) and \
+			(x2, y2) not in seen:
+				queue.append(path + [(x2, y2)])
+				seen.add((x2, y2))
+	return False
+
+def _route_positions(map, dsize):
+	"""Positions on the shortest route, start included as the old BFS path has it, False if unreachable"""
+	dist = distance_field(map, dsize)[0, 0]
+	return False if dist < 0 else dist + 1
+
+def _old_route_len(map, w, h, dsize):
+	path = _compute_shortest_route(w, h, dsize, Symbols(), decode_map(map), (0, 0))
+	return False if path is False else len(path)
+
+CONFIGS = [(8, 8, 1, 0.8), (8, 8, 2, 0.8), (8, 8, 3, 0.9), (12, 10, 2, 0.8), (16, 16, 3, 0.9)]
+
+@pytest.mark.parametrize("w,h,dsize,p", CONFIGS)
+def test_route_len_matches_old_bfs(w, h, dsize, p):
+	np.random.seed(dsize)
+	mapclass = MakeMap(w=w, h=h, dsize=dsize, p=p)
+	oracle = PathOracle(w, h, dsize)
+	for _ in range(100):
+		map = mapclass.gen_random_map()
+		old = _old_route_len(map, w, h, dsize)
+		assert old is not False
+		assert _route_positions(map, dsize) == old
+		assert oracle.distance(map) + 1 == old
+
+@pytest.mark.parametrize("w,h,dsize,p", CONFIGS)
+def test_unreachable_goal(w, h, dsize, p):
+	# Raw boards skip gen_random_map's reachability check, denser ones block more often
+	np.random.seed(dsize)
+	mapclass = MakeMap(w=w, h=h, dsize=dsize, p=min(p, 0.7))
+	oracle = PathOracle(w, h, dsize)
+	n_unreachable = 0
+	for _ in range(200):
+		mapclass._make_map()
+		map = mapclass.map
+		old = _old_route_len(map, w, h, dsize)
+		assert _route_positions(map, dsize) == old
+		assert oracle.reachable(map) == (old is not False)
+		n_unreachable += old is False
+	assert n_unreachable > 0
+
+@pytest.mark.parametrize("dsize", [1, 2, 3])
+def test_walled_off_goal(dsize):
+	w = h = 10
+	mapclass = MakeMap(w=w, h=h, dsize=dsize, p=1.0)
+	map = mapclass.gen_random_map().copy()
+	map[h//2, :] = mapclass.symbols.Static_module
+	assert _old_route_len(map, w, h, dsize) is False
+	assert _route_positions(map, dsize) is False
+	assert not PathOracle(w, h, dsize).reachable(map)
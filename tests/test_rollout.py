@@ -0,0 +1,89 @@
+import numpy as np
+import torch as T
+import pytest
+
+from lib.rollout import nstep_returns, gae_advantages
+
+GAMMA = 0.9
+
+def _rollout(n_steps=7, n_envs=4, seed=0):
+	"""
+	Random (T, N) segment with the episode ends that matter: env 0 ends in
+	the middle, env 1 at the last step, env 2 never (bootstraps from
+	last_values), env 3 at random steps.
+	"""
+	rng = np.random.RandomState(seed)
+	rewards = rng.randn(n_steps, n_envs)
+	values = rng.randn(n_steps, n_envs)
+	last_values = rng.randn(n_envs)
+	dones = np.zeros((n_steps, n_envs))
+	dones[n_steps//2, 0] = 1.0
+	dones[n_steps-1, 1] = 1.0
+	dones[:, 3] = rng.rand(n_steps) < 0.3
+	return rewards, dones, values, last_values
+
+def _tensors(*arrays):
+	return [T.tensor(a, dtype=T.float64) for a in arrays]
+
+def _ref_nstep(rewards, dones, values, last_values, gamma, steps_count):
+	n_steps, n_envs = rewards.shape
+	returns = np.zeros_like(rewards)
+	for n in range(n_envs):
+		for t in range(n_steps):
+			ret = 0.0
+			for k in range(steps_count):
+				if t+k == n_steps:
+					ret += gamma**k * last_values[n]
+					break
+				ret += gamma**k * rewards[t+k, n]
+				if dones[t+k, n]:
+					break
+			else:
+				end = t + steps_count
+				ret += gamma**steps_count * (values[end, n] if end < n_steps else last_values[n])
+			returns[t, n] = ret
+	return returns
+
+def _ref_gae(rewards, dones, values, last_values, gamma, gae_lambda):
+	n_steps, n_envs = rewards.shape
+	advantages = np.zeros_like(rewards)
+	for n in range(n_envs):
+		for t in range(n_steps):
+			adv, coef = 0.0, 1.0
+			for l in range(t, n_steps):
+				next_value = values[l+1, n] if l+1 < n_steps else last_values[n]
+				adv += coef * (rewards[l, n] + gamma * next_value * (1.0 - dones[l, n]) - values[l, n])
+				if dones[l, n]:
+					break
+				coef *= gamma * gae_lambda
+			advantages[t, n] = adv
+	return advantages
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+@pytest.mark.parametrize("steps_count", [1, 2, 3, 7, 10])
+def test_nstep_returns_matches_reference(seed, steps_count):
+	arrays = _rollout(seed=seed)
+	returns = nstep_returns(*_tensors(*arrays), GAMMA, steps_count)
+	np.testing.assert_allclose(returns.numpy(), _ref_nstep(*arrays, GAMMA, steps_count), rtol=1e-12, atol=1e-12)
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+@pytest.mark.parametrize("gae_lambda", [0.0, 0.95, 1.0])
+def test_gae_advantages_matches_reference(seed, gae_lambda):
+	arrays = _rollout(seed=seed)
+	values = arrays[2]
+	advantages, ref_values = gae_advantages(*_tensors(*arrays), GAMMA, gae_lambda)
+	expected = _ref_gae(*arrays, GAMMA, gae_lambda)
+	np.testing.assert_allclose(advantages.numpy(), expected, rtol=1e-12, atol=1e-12)
+	np.testing.assert_allclose(ref_values.numpy(), expected + values, rtol=1e-12, atol=1e-12)
+
+def test_bootstrap_from_last_values():
+	# One env, no episode end: the whole segment bootstraps from last_values
+	rewards, dones, values, last_values = _tensors([[1.0], [2.0]], [[0.0], [0.0]], [[5.0], [7.0]], [10.0])
+	returns = nstep_returns(rewards, dones, values, last_values, GAMMA, 3)
+	np.testing.assert_allclose(returns[:, 0].numpy(), [1.0 + GAMMA*2.0 + GAMMA**2*10.0, 2.0 + GAMMA*10.0])
+	advantages, _ = gae_advantages(rewards, dones, values, last_values, GAMMA, 1.0)
+	np.testing.assert_allclose(advantages[:, 0].numpy(), [1.0 + GAMMA*2.0 + GAMMA**2*10.0 - 5.0, 2.0 + GAMMA*10.0 - 7.0])
+	# An episode end at the last step drops the bootstrap
+	dones[1, 0] = 1.0
+	returns = nstep_returns(rewards, dones, values, last_values, GAMMA, 3)
+	np.testing.assert_allclose(returns[:, 0].numpy(), [1.0 + GAMMA*2.0, 2.0])
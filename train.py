@@ -1,8 +1,15 @@
 import os
+import sys
+import atexit
+import copy
+import time
+import queue
 import gym
 import ptan
 import numpy as np
 import argparse
+import multiprocessing as mp
+from typing import Final
 from tensorboardX import SummaryWriter
 
 import torch as T
@@ -12,9 +19,22 @@ import torch.nn.functional as F
 import torch.optim as optim
 
 from lib import common
+from lib.rollout import RolloutBuffer
+from lib.rollout import ValueExperienceSourceFirstLast
+from lib.rollout import VectorRollout, nstep_returns, gae_advantages
+from lib.profiler import PhaseProfiler, CaptureWindow
+from lib.curriculum import Curriculum
+from lib import checkpoint
 
 from sub_envs.static import MEDAEnv
 #from sub_envs.dynamic import MEDAEnv
+from sub_envs.vector import VectorMEDAEnv
+from sub_envs.map_bank import MapBank
+from sub_envs.prefetch import MapPrefetcher
+from sub_envs.pool import SubprocMEDAEnv
+from sub_envs.oracle import PathOracle
+from sub_envs.expert import load_dataset, dataset_info
+from sub_envs.obs import OBS_MODES, OBS_LAYOUTS, N_PLANES, obs_shape, observation_space, pack_obs
 
 GAMMA = 0.99
 LEARNING_RATE = 1e-4
@@ -24,18 +44,76 @@ W = 8
 H = 8
 DSIZE = 1
 P = 0.9
+NUM_ENVS = 1		#Boards stepped together by VectorMEDAEnv when > 1
+NUM_WORKERS = 0		#Processes stepping the boards, 0 to step them in this process
+MAP_BANK = None		#MapBank file to sample boards from instead of generating them
+PREFETCH_WORKERS = 0	#Processes generating boards ahead of reset, 0 to generate in reset
+BC_EPOCHS = 5		#Behaviour cloning epochs over --bc-dataset before A2C
+BC_LEARNING_RATE = 1e-3
+BC_BATCH_SIZE = 256
+OBS_MODE = "float"	#float, uint8 or bit-packed observations, see sub_envs/obs.py
+OBS_LAYOUT = "whc"	#(w, h, 3) observations, or channels-first (3, h, w) with chw
+NET = "atari"	#AtariA2C for one board size, or the fully convolutional FCA2C
+FC_LOGITS = "cell"	#FCA2C actions from per-cell logits under the droplet, or global pooling
+CHECKPOINT_EVERY = 30000	#Games between training state checkpoints
+KEEP_CHECKPOINTS = 3	#Training state checkpoints kept, older ones are deleted
+CURRICULUM_TARGET = 0.8	#Success rate that moves --curriculum to the next stage, see lib/curriculum.py
+SHAPED_REWARD = False	#Reward progress along shortest routes instead of straight-line distance
 
 USEGPU = False
 OPTIMIZER= "Adam"	#Adam or SGD
 
 REWARD_STEPS = 1
+ROLLOUT_STEPS = 0	#Steps per (steps, envs) rollout segment, 0 to train from single experiences
+GAE_LAMBDA = None	#Advantages of rollout segments by GAE(lambda), None for REWARD_STEPS returns
 CLIP_GRAD = 0.1
+PROFILE_INTERVAL = 100	#Batches between phase profile summaries with --profile
+GRAD_DIAG_INTERVAL = 100	#Batches between gradient statistics with --fused-backward, 0 to disable
 SGAMMA = 0.9
 
 
-class AtariA2C(nn.Module):
-	def __init__(self, input_shape, n_actions):
+class UnpackBits(nn.Module):
+	"""Expands bit-packed (B, ceil(n/8)) uint8 observations into (B,) + shape 0/1 planes"""
+	def __init__(self, shape):
+		super(UnpackBits, self).__init__()
+		self.shape = list(shape)
+		self.n_bits = int(np.prod(shape))
+		# np.packbits order, most significant bit first
+		self.register_buffer("shifts", T.arange(7, -1, -1, dtype=T.uint8), persistent=False)
+
+	def forward(self, x):
+		bits = (x.unsqueeze(-1) >> self.shifts) & 1
+		return bits.flatten(1)[:, :self.n_bits].reshape([x.shape[0]] + self.shape)
+
+
+class A2CNet(nn.Module):
+	"""Checkpoint saving and loading of the actor-critic nets, which provide export_inference"""
+	def save_checkpoint(self, checkpoint_path):
+		print("... saving checkpoint ...")
+		T.save(self.state_dict(), checkpoint_path)
+
+	def load_checkpoint(self, checkpoint_path, inference=None, policy_only=False):
+		"""
+		Load the weights, and return an inference module of them exported with
+		the given mode when inference is set (see export_inference).
+		"""
+		self.load_state_dict(T.load(checkpoint_path))
+		if inference is not None:
+			return self.export_inference(mode=inference, policy_only=policy_only)
+
+
+class AtariA2C(A2CNet):
+	def __init__(self, input_shape, n_actions, packed=False, obs_layout="whc"):
 		super(AtariA2C, self).__init__()
+		self.input_shape = tuple(input_shape)
+		# Bit-packed observations (sub_envs.obs "packed") are expanded on the device
+		self.packed = packed
+		self.unpack = UnpackBits(input_shape) if packed else nn.Identity()
+		# The first conv takes input_shape[0] channels: the 3 planes of "chw"
+		# observations, the board width of "whc" ones (kept for old checkpoints)
+		self.obs_layout = obs_layout
+		if obs_layout == "chw":
+			assert self.input_shape[0] == N_PLANES, "chw input shape %s is not (3, h, w)" % (self.input_shape,)
 
 		self.conv = nn.Sequential(
 			nn.Conv2d(input_shape[0], 64, 1, stride=1),
@@ -64,16 +142,167 @@ class AtariA2C(nn.Module):
 		return int(np.prod(o.size()))
 
 	def forward(self, x):
-		fx = x.float()/2
+		fx = self.unpack(x).float()/2
 		conv_out = self.conv(fx).view(fx.size()[0], -1)
 		return self.policy(conv_out), self.value(conv_out)
 
-	def save_checkpoint(self, checkpoint_path):
-		print("... saveing checkpoint ...")
-		T.save(self.state_dict(), checkpoint_path)
+	def export_inference(self, mode="script", policy_only=False, share_weights=False):
+		"""
+		A2CInference of this net as eager, TorchScript (script/trace) or
+		torch.compile module. With share_weights it follows this net's updates,
+		which rollouts need, otherwise it is a frozen copy for evaluation.
+		"""
+		module = A2CInference(self, policy_only=policy_only, share_weights=share_weights)
+		if not share_weights:
+			module.eval().requires_grad_(False)
+		if mode == "script":
+			return T.jit.script(module)
+		if mode == "trace":
+			device = next(self.parameters()).device
+			if self.packed:
+				example = T.zeros((1, (int(np.prod(self.input_shape)) + 7) // 8), dtype=T.uint8, device=device)
+			else:
+				example = T.zeros((1,) + self.input_shape, device=device)
+			return T.jit.trace(module, example)
+		if mode == "compile":
+			return T.compile(module)
+		assert mode == "eager", "unknown inference mode %s" % mode
+		return module
+
+
+class A2CInference(nn.Module):
+	"""
+	Forward-only AtariA2C. A frozen copy folds the /2 input scaling into the
+	first conv; with policy_only only the logits are computed and returned.
+	"""
+	policy_only: Final[bool]
+	scale: Final[float]
+
+	def __init__(self, net, policy_only=False, share_weights=False):
+		super(A2CInference, self).__init__()
+		self.policy_only = policy_only
+		self.unpack = net.unpack
+		if share_weights:
+			self.conv = net.conv
+			self.policy = net.policy
+			self.value = net.value
+			self.scale = 0.5
+		else:
+			self.conv = copy.deepcopy(net.conv)
+			self.policy = copy.deepcopy(net.policy)
+			self.value = copy.deepcopy(net.value)
+			# conv(x/2) == conv'(x) with the first layer's weights halved
+			with T.no_grad():
+				self.conv[0].weight.mul_(0.5)
+			self.scale = 1.0
 
-	def load_checkpoint(self, checkpoint_path):
-		self.load_state_dict(T.load(checkpoint_path))
+	def forward(self, x):
+		fx = self.unpack(x).float()
+		if self.scale != 1.0:
+			fx = fx * self.scale
+		conv_out = self.conv(fx).flatten(1)
+		if self.policy_only:
+			return self.policy(conv_out)
+		return self.policy(conv_out), self.value(conv_out)
+
+
+class FCA2C(A2CNet):
+	"""
+	Fully convolutional actor-critic over channels-first (3, h, w) boards of
+	any size. The trunk keeps the board resolution and adds a pooled summary
+	of the board back to every cell. Actions are read from per-cell logits
+	under the droplet ("cell") or from the pooled features ("global"), the
+	value always from the pooled features.
+	"""
+	per_cell: Final[bool]
+
+	def __init__(self, n_actions, channels=64, logits="cell"):
+		super(FCA2C, self).__init__()
+		assert logits in ("cell", "global"), "unknown logits %s" % logits
+		self.per_cell = logits == "cell"
+		self.packed = False
+		self.obs_layout = "chw"
+
+		self.trunk = nn.Sequential(
+			nn.Conv2d(N_PLANES, channels, 3, padding=1),
+			nn.ReLU(),
+			nn.Conv2d(channels, channels, 3, padding=1),
+			nn.ReLU(),
+			nn.Conv2d(channels, channels, 3, padding=1),
+			nn.ReLU()
+		)
+		self.context = nn.Linear(2*channels, channels)
+
+		if self.per_cell:
+			self.policy = nn.Conv2d(channels, n_actions, 1)
+		else:
+			self.policy = nn.Sequential(
+				nn.Linear(2*channels, 128),
+				nn.ReLU(),
+				nn.Linear(128, n_actions)
+			)
+
+		self.value = nn.Sequential(
+			nn.Linear(2*channels, 128),
+			nn.ReLU(),
+			nn.Linear(128, 1)
+		)
+
+	@staticmethod
+	def _pool(h):
+		return T.cat((h.mean((2, 3)), h.amax((2, 3))), 1)
+
+	def features(self, x):
+		""":return: per-cell features (B, C, h, w) and the pooled ones (B, 2C)"""
+		h = self.trunk(x)
+		h = F.relu(h + self.context(self._pool(h))[:, :, None, None])
+		return h, self._pool(h)
+
+	def logits(self, x, h, pooled):
+		if self.per_cell:
+			# Mean of the cell logits under the droplet footprint (plane 0)
+			mask = x[:, :1]
+			return (self.policy(h) * mask).sum((2, 3)) / mask.sum((2, 3)).clamp(min=1.0)
+		return self.policy(pooled)
+
+	def forward(self, x):
+		fx = x.float()
+		h, pooled = self.features(fx)
+		return self.logits(fx, h, pooled), self.value(pooled)
+
+	def export_inference(self, mode="script", policy_only=False, share_weights=False):
+		"""Same as AtariA2C.export_inference, a trace generalizes over board sizes"""
+		module = FCA2CInference(self, policy_only=policy_only, share_weights=share_weights)
+		if not share_weights:
+			module.eval().requires_grad_(False)
+		if mode == "script":
+			return T.jit.script(module)
+		if mode == "trace":
+			example = T.zeros((1, N_PLANES, 8, 8), device=next(self.parameters()).device)
+			return T.jit.trace(module, example)
+		if mode == "compile":
+			# Board sizes change the input shape, so compile for dynamic shapes
+			return T.compile(module, dynamic=True)
+		assert mode == "eager", "unknown inference mode %s" % mode
+		return module
+
+
+class FCA2CInference(nn.Module):
+	"""Forward-only FCA2C, with policy_only the value head is skipped"""
+	policy_only: Final[bool]
+
+	def __init__(self, net, policy_only=False, share_weights=False):
+		super(FCA2CInference, self).__init__()
+		self.policy_only = policy_only
+		self.net = net if share_weights else copy.deepcopy(net)
+
+	def forward(self, x):
+		fx = x.float()
+		h, pooled = self.net.features(fx)
+		logits = self.net.logits(fx, h, pooled)
+		if self.policy_only:
+			return logits
+		return logits, self.net.value(pooled)
 
 
 def unpack_batch(batch, net, device='cpu'):
@@ -108,9 +337,317 @@ def unpack_batch(batch, net, device='cpu'):
 	return states_v, actions_t, ref_vals_v
 
 
+def unpack_buffer(buffer, net, device='cpu'):
+	"""
+	Same as unpack_batch, for experiences already collected in a RolloutBuffer.
+	Values cached at action selection are used instead of a forward over last states.
+	:return: states variable, actions tensor, reference values variable
+	"""
+	states_v, actions_t, rewards_v, last_states_v, not_done_v, last_vals_v = buffer.batch(device)
+	if not buffer.cached_values:
+		with T.no_grad():
+			last_vals_v = net(last_states_v)[1].squeeze(-1)
+	ref_vals_v = rewards_v + not_done_v * last_vals_v * GAMMA ** REWARD_STEPS
+	return states_v, actions_t, ref_vals_v
+
+
+def unpack_rollout(rollout, gae_lambda=None):
+	"""
+	Flatten a (T, N) rollout segment into a training batch, with REWARD_STEPS
+	returns or GAE(lambda) advantages computed over the whole segment at once.
+	:return: states variable, actions tensor, reference values variable, advantages variable
+	"""
+	if gae_lambda is None:
+		ref_vals_v = nstep_returns(rollout.rewards, rollout.dones, rollout.values, rollout.last_values, GAMMA, REWARD_STEPS)
+		adv_v = ref_vals_v - rollout.values
+	else:
+		adv_v, ref_vals_v = gae_advantages(rollout.rewards, rollout.dones, rollout.values, rollout.last_values, GAMMA, gae_lambda)
+	states_v = rollout.states.flatten(0, 1)
+	return states_v, rollout.actions.flatten(), ref_vals_v.flatten(), adv_v.flatten()
+
+
+def calc_losses(net, states_v, actions_t, vals_ref_v, adv_v=None):
+	logits_v, value_v = net(states_v)
+	loss_value_v = F.mse_loss(value_v.squeeze(-1), vals_ref_v)
+
+	log_prob_v = F.log_softmax(logits_v, dim=1)
+	if adv_v is None:
+		adv_v = vals_ref_v - value_v.detach()
+	log_prob_actions_v = adv_v * log_prob_v[range(len(actions_t)), actions_t]
+	loss_policy_v = -log_prob_actions_v.mean()
+
+	prob_v = F.softmax(logits_v, dim=1)
+	entropy_loss_v = ENTROPY_BETA * (prob_v * log_prob_v).sum(dim=1).mean()
+
+	return loss_policy_v, entropy_loss_v, loss_value_v, adv_v, value_v
+
+
+def grad_stats(net):
+	"""
+	RMS, max abs and variance of all parameter gradients, reduced on the
+	device so only three scalars reach the host.
+	"""
+	grads_v = T.cat([p.grad.detach().flatten() for p in net.parameters() if p.grad is not None])
+	stats_v = T.stack((grads_v.square().mean().sqrt(), grads_v.abs().max(), grads_v.var(unbiased=False)))
+	return stats_v.tolist()
+
+
+def train_step(net, optimizer, states_v, actions_t, vals_ref_v, adv_v=None, fused=False, grad_diag=True):
+	"""
+	One A2C update on a batch. By default the policy gradient is backpropagated
+	on its own first so its statistics can be taken, fused runs a single
+	backward over the total loss. Gradients are clipped to CLIP_GRAD.
+	:return: policy, entropy, value and total losses, advantages, values and
+		the gradient (l2, max, var) before clipping, None without grad_diag
+	"""
+	optimizer.zero_grad()
+	loss_policy_v, entropy_loss_v, loss_value_v, adv_v, value_v = calc_losses(net, states_v, actions_t, vals_ref_v, adv_v)
+	grads = None
+
+	if fused:
+		loss_v = loss_policy_v + entropy_loss_v + loss_value_v
+		loss_v.backward()
+		# statistics of the full gradient, before clipping
+		if grad_diag:
+			grads = grad_stats(net)
+		nn_utils.clip_grad_norm_(net.parameters(), CLIP_GRAD)
+		optimizer.step()
+	else:
+		# calculate policy gradients only
+		loss_policy_v.backward(retain_graph=True)
+		if grad_diag:
+			policy_grads = np.concatenate([p.grad.data.cpu().numpy().flatten()
+									for p in net.parameters()
+									if p.grad is not None])
+			grads = (np.sqrt(np.mean(np.square(policy_grads))), np.max(np.abs(policy_grads)), np.var(policy_grads))
+
+		# apply entropy and value gradients
+		loss_v = entropy_loss_v + loss_value_v
+		loss_v.backward()
+		nn_utils.clip_grad_norm_(net.parameters(), CLIP_GRAD)
+		optimizer.step()
+		# get full loss
+		loss_v += loss_policy_v
+
+	return loss_policy_v, entropy_loss_v, loss_value_v, loss_v, adv_v, value_v, grads
+
+
+def pretrain_policy(net, dataset_path, epochs, writer=None, device="cpu"):
+	"""
+	Behaviour cloning warm start: fit the policy head and the shared conv
+	layers to the expert moves of a sub_envs.expert dataset with cross-entropy.
+	The value head is left to A2C.
+	"""
+	obs, actions = load_dataset(dataset_path)
+	# whc and chw are each other's transpose
+	if dataset_info(dataset_path)["obs_layout"] != net.obs_layout:
+		obs = np.ascontiguousarray(obs.transpose(0, 3, 2, 1))
+	if net.packed:
+		obs = pack_obs(obs, n_batch_dims=1)
+	states_t = T.from_numpy(obs)
+	actions_t = T.from_numpy(actions)
+	policy = net.export_inference(mode="eager", policy_only=True, share_weights=True)
+	optimizer = optim.Adam(net.parameters(), lr=BC_LEARNING_RATE)
+	print("Behaviour cloning on %d expert moves" % len(actions_t))
+
+	for epoch in range(epochs):
+		perm = T.randperm(len(actions_t))
+		total_loss = 0.0
+		n_correct = 0
+		for start in range(0, len(perm), BC_BATCH_SIZE):
+			idx = perm[start:start+BC_BATCH_SIZE]
+			states_v = states_t[idx].to(device)
+			actions_v = actions_t[idx].to(device)
+			logits_v = policy(states_v)
+			loss_v = F.cross_entropy(logits_v, actions_v)
+			optimizer.zero_grad()
+			loss_v.backward()
+			optimizer.step()
+			total_loss += loss_v.item() * len(idx)
+			n_correct += (logits_v.argmax(dim=1) == actions_v).sum().item()
+		print("bc epoch %d, loss %.4f, accuracy %.3f" % (epoch, total_loss/len(perm), n_correct/len(perm)))
+		sys.stdout.flush()
+		if writer is not None:
+			writer.add_scalar("bc loss", total_loss/len(perm), epoch)
+			writer.add_scalar("bc accuracy", n_correct/len(perm), epoch)
+
+
+def make_env(args, w, h, dsize, p, map_bank=None, prefetcher=None, oracle=None):
+	if args.num_workers > 0:
+		return SubprocMEDAEnv(n_envs=args.num_envs, n_workers=args.num_workers, w=w, h=h, dsize=dsize, p=p, map_bank=map_bank, prefetcher=prefetcher, oracle=oracle, obs_mode=args.obs_mode, obs_layout=args.obs_layout)
+	if args.num_envs > 1 or args.cached_values or args.rollout_steps > 0:
+		return VectorMEDAEnv(n_envs=args.num_envs, w=w, h=h, dsize=dsize, p=p, map_bank=map_bank, prefetcher=prefetcher, oracle=oracle, obs_mode=args.obs_mode, obs_layout=args.obs_layout)
+	return MEDAEnv(w=w, h=h, dsize=dsize, p=p, map_bank=map_bank, prefetcher=prefetcher, oracle=oracle, obs_mode=args.obs_mode, obs_layout=args.obs_layout)
+
+
+def make_exp_source(args, env, actor, policy, device):
+	if args.rollout_steps > 0:
+		return VectorRollout(env, actor, args.rollout_steps, device=device)
+	if args.cached_values:
+		return ValueExperienceSourceFirstLast(env, actor, gamma=GAMMA, steps_count=REWARD_STEPS, device=device)
+	if args.num_envs > 1 or args.num_workers > 0:
+		agent = ptan.agent.PolicyAgent(policy, apply_softmax=True, device=device, preprocessor=common.obs_preprocessor)
+		return common.VectorExperienceSourceFirstLast(env, agent, gamma=GAMMA, steps_count=REWARD_STEPS)
+	agent = ptan.agent.PolicyAgent(policy, apply_softmax=True, device=device)
+	return ptan.experience.ExperienceSourceFirstLast(env, agent, gamma=GAMMA, steps_count=REWARD_STEPS)
+
+
+def make_buffer(args, w, h, device):
+	return RolloutBuffer(BATCH_SIZE, observation_space(obs_shape(w, h, args.obs_layout), args.obs_mode), device=device,
+		cached_values=args.cached_values, obs_dtype=T.float32 if args.obs_mode == "float" else T.uint8)
+
+
+def train_state(net, optimizer, tracker, curriculum, n_games, frame, n_batches):
+	"""Everything --resume needs to carry on training, see lib/checkpoint.py"""
+	return {
+		"model": net.state_dict(),
+		"optimizer": optimizer.state_dict(),
+		"tracker": tracker.state_dict(),
+		"curriculum": curriculum.state_dict() if curriculum is not None else None,
+		"rng": checkpoint.rng_state(),
+		"n_games": n_games,
+		"frame": frame,
+		"n_batches": n_batches,
+	}
+
+
+def a3c_worker(shared_net, optimizer, num_envs, seed, samples, rewards_queue, stop):
+	T.set_num_threads(1)
+	np.random.seed(seed)
+	T.manual_seed(seed)
+	# Rewards still buffered at shutdown are dropped instead of blocking exit
+	rewards_queue.cancel_join_thread()
+
+	map_bank = MapBank(MAP_BANK) if MAP_BANK is not None else None
+	env = VectorMEDAEnv(n_envs=num_envs, w=W, h=H, dsize=DSIZE, p=P, map_bank=map_bank)
+	net = AtariA2C(env.observation_space, env.action_space)
+	net.load_state_dict(shared_net.state_dict())
+
+	agent = ptan.agent.PolicyAgent(lambda x: net(x)[0], apply_softmax=True, preprocessor=common.float32_preprocessor)
+	exp_source = common.VectorExperienceSourceFirstLast(env, agent, gamma=GAMMA, steps_count=REWARD_STEPS)
+
+	buffer = RolloutBuffer(BATCH_SIZE, env.observation_space)
+	for exp in exp_source:
+		if stop.is_set():
+			break
+		buffer.append(exp)
+		for new_reward in exp_source.pop_total_rewards():
+			rewards_queue.put(new_reward)
+
+		if len(buffer) < BATCH_SIZE:
+			continue
+
+		states_v, actions_t, vals_ref_v = unpack_buffer(buffer, net)
+
+		net.zero_grad()
+		loss_policy_v, entropy_loss_v, loss_value_v, _, _ = calc_losses(net, states_v, actions_t, vals_ref_v)
+		(loss_policy_v + entropy_loss_v + loss_value_v).backward()
+		nn_utils.clip_grad_norm_(net.parameters(), CLIP_GRAD)
+
+		# Apply the local gradients to the shared net, then pull its weights back
+		for param, shared_param in zip(net.parameters(), shared_net.parameters()):
+			shared_param.grad = param.grad
+		optimizer.step()
+		net.load_state_dict(shared_net.state_dict())
+
+		buffer.clear()
+		with samples.get_lock():
+			samples.value += BATCH_SIZE
+
+
+def run_a3c(n_workers, num_envs, checkpoint_path, tracker=None, seconds=None):
+	"""
+	Asynchronous A2C: every worker runs its own boards and applies its gradients
+	to a shared AtariA2C through SharedAdam. Runs until the tracker reports the
+	last epoch or for the given seconds, and returns the samples per second.
+	"""
+	env = VectorMEDAEnv(n_envs=1, w=W, h=H, dsize=DSIZE, p=P)
+	shared_net = AtariA2C(env.observation_space, env.action_space)
+	shared_net.share_memory()
+	optimizer = common.SharedAdam(shared_net.parameters(), lr=LEARNING_RATE)
+
+	samples = mp.Value("l", 0)
+	rewards_queue = mp.Queue()
+	stop = mp.Event()
+	seed = np.random.SeedSequence().entropy
+	procs = []
+	for idx in range(n_workers):
+		worker_seed = int(np.random.SeedSequence([seed, idx]).generate_state(1)[0])
+		proc = mp.Process(target=a3c_worker, args=(shared_net, optimizer, num_envs, worker_seed, samples, rewards_queue, stop))
+		proc.start()
+		procs.append(proc)
+
+	n_games = 0
+	ts_start = ts = time.time()
+	ts_samples = 0
+	while seconds is None or time.time() - ts_start < seconds:
+		try:
+			new_reward = rewards_queue.get(timeout=1.0)
+		except queue.Empty:
+			new_reward = None
+		if new_reward is not None:
+			n_games += 1
+			if tracker is not None:
+				if n_games%30000 == 0:
+					shared_net.save_checkpoint(checkpoint_path)
+				if tracker.reward(new_reward, samples.value, n_games):
+					break
+
+		if time.time() - ts > 10:
+			speed = (samples.value - ts_samples) / (time.time() - ts)
+			print("a3c workers %d, %.2f samples/s, %.2f samples/s per worker" % (n_workers, speed, speed/n_workers))
+			sys.stdout.flush()
+			if tracker is not None:
+				tracker.writer.add_scalar("a3c samples per sec", speed, n_games)
+			ts = time.time()
+			ts_samples = samples.value
+
+	speed = samples.value / (time.time() - ts_start)
+	stop.set()
+	for proc in procs:
+		proc.join()
+	return speed
+
+
 if __name__ == "__main__":
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--num-envs", type=int, default=NUM_ENVS, help="Boards stepped per batch")
+	parser.add_argument("--num-workers", type=int, default=NUM_WORKERS, help="Env processes, 0 to step in the learner")
+	parser.add_argument("--cached-values", default=False, action="store_true", help="Bootstrap from values computed when acting instead of a second forward")
+	parser.add_argument("--fused-backward", default=False, action="store_true", help="One backward over the total loss instead of separate policy and value passes")
+	parser.add_argument("--grad-diag-interval", type=int, default=GRAD_DIAG_INTERVAL, help="Batches between gradient statistics with --fused-backward, 0 to disable")
+	parser.add_argument("--rollout-steps", type=int, default=ROLLOUT_STEPS, help="Train on (steps, envs) rollout segments of this length, 0 for single experiences")
+	parser.add_argument("--gae-lambda", type=float, default=GAE_LAMBDA, help="GAE(lambda) advantages for rollout segments instead of REWARD_STEPS returns")
+	parser.add_argument("--inference", default="eager", choices=["eager", "script", "trace", "compile"], help="Module used to pick actions in rollouts")
+	parser.add_argument("--shaped-reward", default=SHAPED_REWARD, action="store_true", help="Reward progress along shortest routes (PathOracle)")
+	parser.add_argument("--bc-dataset", default=None, help="Expert dataset (python -m sub_envs.expert) to pretrain the policy on")
+	parser.add_argument("--bc-epochs", type=int, default=BC_EPOCHS, help="Behaviour cloning epochs over --bc-dataset")
+	parser.add_argument("--profile", default=False, action="store_true", help="Time env, map generation, forward, unpack and learner phases")
+	parser.add_argument("--profile-capture", default=None, choices=["cprofile", "torch"], help="Also capture a cProfile or torch.profiler window")
+	parser.add_argument("--profile-start", type=int, default=100, help="First batch of the capture window")
+	parser.add_argument("--profile-batches", type=int, default=20, help="Batches in the capture window")
+	parser.add_argument("--obs-mode", default=OBS_MODE, choices=OBS_MODES, help="Observation encoding of the envs and the rollout storage")
+	parser.add_argument("--obs-layout", default=OBS_LAYOUT, choices=OBS_LAYOUTS, help="Observation layout, chw feeds the planes to the net as channels")
+	parser.add_argument("--net", default=NET, choices=["atari", "fc"], help="fc trains FCA2C, one net for any board size (channels-first)")
+	parser.add_argument("--fc-logits", default=FC_LOGITS, choices=["cell", "global"], help="FCA2C policy head")
+	parser.add_argument("--curriculum", default=False, action="store_true", help="Train on the growing boards of lib/curriculum.py stages, needs --net fc")
+	parser.add_argument("--curriculum-target", type=float, default=CURRICULUM_TARGET, help="Success rate that ends a curriculum stage")
+	parser.add_argument("--resume", default=None, help="Training state to resume from, a checkpoint file or directory (its latest)")
+	parser.add_argument("--mode", default="a2c", choices=["a2c", "a3c"], help="Synchronous A2C or asynchronous A3C learners")
+	parser.add_argument("--a3c-workers", type=int, default=os.cpu_count(), help="Learner processes in a3c mode")
+	parser.add_argument("--a3c-scaling", default=None, help="Comma separated worker counts to measure a3c throughput for, e.g. 1,2,4,8")
+	parser.add_argument("--a3c-seconds", type=float, default=60, help="Seconds to run each --a3c-scaling point")
+	args = parser.parse_args()
+	if args.num_workers > args.num_envs:
+		parser.error("--num-workers needs --num-envs >= --num-workers")
+	single_env = args.num_envs == 1 and args.num_workers == 0 and not args.cached_values and args.rollout_steps == 0
+	if args.curriculum and (args.net != "fc" or single_env):
+		parser.error("--curriculum needs --net fc and vector envs")
+	if args.net == "fc":
+		if args.obs_mode == "packed":
+			parser.error("--net fc takes float or uint8 observations")
+		args.obs_layout = "chw"
 
-	env = MEDAEnv(w=W, h=H, dsize=DSIZE, p=P)
 	env_name = "LR=" + str(LEARNING_RATE) + "_EB=" + str(ENTROPY_BETA)
 	writer = SummaryWriter(comment = env_name)
 
@@ -118,17 +655,79 @@ if __name__ == "__main__":
 		os.makedirs("saves")
 	checkpoint_path = "saves/" + env_name
 
+	if args.mode == "a3c":
+		if args.a3c_scaling is not None:
+			base_speed = None
+			for n_workers in [int(k) for k in args.a3c_scaling.split(",")]:
+				speed = run_a3c(n_workers, args.num_envs, checkpoint_path, seconds=args.a3c_seconds)
+				base_speed = base_speed or speed / n_workers
+				print("a3c scaling: %d workers, %.2f samples/s, speedup %.2f, efficiency %.2f"
+					%(n_workers, speed, speed/base_speed, speed/base_speed/n_workers))
+				writer.add_scalar("a3c scaling samples per sec", speed, n_workers)
+			writer.close()
+		else:
+			with common.RewardTracker(writer) as tracker:
+				run_a3c(args.a3c_workers, args.num_envs, checkpoint_path, tracker=tracker)
+		sys.exit(0)
+
+	resume = checkpoint.load(args.resume) if args.resume is not None else None
+
+	# Boards grow with the curriculum stages, size-specific map sources are not used then
+	curriculum = None
+	if args.curriculum:
+		curriculum = Curriculum(target=args.curriculum_target)
+		if resume is not None and resume["curriculum"] is not None:
+			curriculum.load_state_dict(resume["curriculum"])
+		W, H, DSIZE, P = curriculum.stage
+	# The expert moves only fit the boards they were played on
+	if args.bc_dataset is not None and resume is None:
+		bc_info = dataset_info(args.bc_dataset)
+		if bc_info is None:
+			parser.error("--bc-dataset %s has no board metadata, rebuild it with python -m sub_envs.expert" % args.bc_dataset)
+		if (bc_info["w"], bc_info["h"], bc_info["dsize"]) != (W, H, DSIZE):
+			parser.error("--bc-dataset %s holds %dx%d dsize %d boards, training runs on %dx%d dsize %d"
+				% (args.bc_dataset, bc_info["w"], bc_info["h"], bc_info["dsize"], W, H, DSIZE))
+		if bc_info["obs_layout"] not in OBS_LAYOUTS:
+			parser.error("--bc-dataset %s has unknown observation layout %s" % (args.bc_dataset, bc_info["obs_layout"]))
+	map_bank = MapBank(MAP_BANK) if MAP_BANK is not None and curriculum is None else None
+	prefetcher = None
+	if PREFETCH_WORKERS > 0 and curriculum is None:
+		prefetcher = MapPrefetcher(W, H, DSIZE, P, workers=PREFETCH_WORKERS).start()
+	oracle = PathOracle(W, H, DSIZE) if args.shaped_reward else None
+	env = make_env(args, W, H, DSIZE, P, map_bank=map_bank, prefetcher=prefetcher, oracle=oracle)
+
 	if USEGPU == True:
 		device = T.device('cuda:0' if T.cuda.is_available else 'cpu')
 	else:
 		device = T.device('cpu')
 	print("Device is ", device)
 
-	net = AtariA2C(env.observation_space, env.action_space).to(device)
+	if args.net == "fc":
+		net = FCA2C(env.action_space, logits=args.fc_logits).to(device)
+	else:
+		net = AtariA2C(env.obs_shape, env.action_space, packed=args.obs_mode == "packed", obs_layout=args.obs_layout).to(device)
 	print(net)
 
-	agent = ptan.agent.PolicyAgent(lambda x: net(x)[0], apply_softmax=True, device=device)
-	exp_source = ptan.experience.ExperienceSourceFirstLast(env, agent, gamma=GAMMA, steps_count=REWARD_STEPS)
+	if resume is not None:
+		net.load_state_dict(resume["model"])
+	elif args.bc_dataset is not None:
+		pretrain_policy(net, args.bc_dataset, args.bc_epochs, writer=writer, device=device)
+
+	# Acting modules share the weights, so they see every optimizer step
+	if args.inference == "eager":
+		actor = net
+		policy = lambda x: net(x)[0]
+	else:
+		actor = net.export_inference(mode=args.inference, share_weights=True)
+		policy = net.export_inference(mode=args.inference, policy_only=True, share_weights=True)
+
+	exp_source = make_exp_source(args, env, actor, policy, device)
+	stream = exp_source
+	if curriculum is not None:
+		def make_stage_source(stage):
+			oracle = PathOracle(stage.w, stage.h, stage.dsize) if args.shaped_reward else None
+			return make_exp_source(args, make_env(args, *stage, oracle=oracle), actor, policy, device)
+		stream = curriculum.experiences(make_stage_source, source=exp_source)
 
 
 	if OPTIMIZER == "Adam":
@@ -138,61 +737,108 @@ if __name__ == "__main__":
 	else:
 		print("Optimizer not found")
 
+	if resume is not None:
+		optimizer.load_state_dict(resume["optimizer"])
+
 #	scheduler = T.optim.lr_scheduler.ExponentialLR(optimizer, gamma=params.sgamma)
 
-	batch = []
+	buffer = make_buffer(args, W, H, device)
+
+	# Phases run in this process only, pool workers are timed as a whole env step
+	profiler = PhaseProfiler(enabled=args.profile)
+	# Summary at exit, also when training is interrupted
+	atexit.register(profiler.dump, os.path.join(writer.logdir, "profile.json"))
+	n_acting = args.num_envs if isinstance(env, (VectorMEDAEnv, SubprocMEDAEnv)) else 1
+	profiler.instrument(env, "step", "env step", samples=n_acting)
+	if hasattr(env, "_get_obs"):
+		profiler.instrument(env, "_get_obs", "env obs")
+	if hasattr(env, "_gen_random_map"):
+		profiler.instrument(env, "_gen_random_map", "map generation")
+	if hasattr(exp_source, "net"):
+		profiler.instrument(exp_source, "net", "forward", samples=n_acting)
+	else:
+		profiler.instrument(exp_source.agent, "model", "forward", samples=n_acting)
+	capture = None
+	if args.profile_capture is not None:
+		capture = CaptureWindow(args.profile_capture, args.profile_start, args.profile_batches,
+			os.path.join(writer.logdir, "capture"))
 
 	n_games = 0
+	n_batches = 0
+	frame_start = 0
+	# Written in the background, the weights also go to checkpoint_path for test.py
+	checkpointer = checkpoint.CheckpointWriter(checkpoint_path + "_state", keep=KEEP_CHECKPOINTS, weights_path=checkpoint_path)
 
 	with common.RewardTracker(writer) as tracker:
+		if resume is not None:
+			n_games, frame_start, n_batches = resume["n_games"], resume["frame"], resume["n_batches"]
+			tracker.load_state_dict(resume["tracker"])
+			checkpoint.set_rng_state(resume["rng"])
+			print("Resuming at %d games, %d frames" % (n_games, frame_start))
 		with ptan.common.utils.TBMeanTracker(writer, batch_size=100) as tb_tracker:
-			for step_idx, exp in enumerate(exp_source):
+			for step_idx, exp in enumerate(stream):
 #				print(exp.reward)
-				batch.append(exp)
+				if args.rollout_steps > 0:
+					# every item is a whole segment, count frames for the tracker
+					step_idx = (step_idx + 1) * args.rollout_steps * args.num_envs
+				else:
+					buffer.append(exp)
+				step_idx += frame_start
 
 				# handle new rewards
-				new_rewards = exp_source.pop_total_rewards()
-				if new_rewards:
+				source = exp_source if curriculum is None else curriculum.source
+				if hasattr(source, "pop_episodes"):
+					new_episodes = source.pop_episodes()
+				else:
+					new_episodes = [(reward, False) for reward in source.pop_total_rewards()]
+				finished = False
+				for new_reward, goal in new_episodes:
 					n_games += 1
-					if n_games%30000 == 0:
-						net.save_checkpoint(checkpoint_path)
-#						scheduler.step()
-
-					if tracker.reward(new_rewards[0], step_idx, n_games):
+					if tracker.reward(new_reward, step_idx, n_games, goal=goal):
+						finished = True
 						break
+					if curriculum is not None and curriculum.update(tracker, step_idx, n_games):
+						# Experiences of the last stage's boards are dropped
+						buffer = make_buffer(args, curriculum.stage.w, curriculum.stage.h, device)
+						curriculum.write(writer, n_games)
+					if n_games % CHECKPOINT_EVERY == 0:
+						checkpointer.save(train_state(net, optimizer, tracker, curriculum, n_games, step_idx, n_batches), n_games)
+#						scheduler.step()
+				if finished:
+					break
 
-				if len(batch) < BATCH_SIZE:
+				if args.rollout_steps > 0:
+					with profiler.phase("unpack"):
+						states_v, actions_t, vals_ref_v, adv_v = unpack_rollout(exp, gae_lambda=args.gae_lambda)
+				elif len(buffer) < BATCH_SIZE:
 					continue
+				else:
+					with profiler.phase("unpack"):
+						states_v, actions_t, vals_ref_v = unpack_buffer(buffer, net, device=device)
+					adv_v = None
+
+				with profiler.phase("learner", samples=len(actions_t)):
+					# With --fused-backward the gradient statistics are only taken every grad_diag_interval batches
+					grad_diag = not args.fused_backward or (args.grad_diag_interval > 0 and n_batches % args.grad_diag_interval == 0)
+					loss_policy_v, entropy_loss_v, loss_value_v, loss_v, adv_v, value_v, grads = train_step(
+						net, optimizer, states_v, actions_t, vals_ref_v, adv_v, fused=args.fused_backward, grad_diag=grad_diag)
+					buffer.clear()
+					if grads is not None:
+						grad_l2, grad_max, grad_var = grads
+						if args.fused_backward:
+							writer.add_scalar("grad_l2", grad_l2, n_games)
+							writer.add_scalar("grad_max", grad_max, n_games)
+							writer.add_scalar("grad_var", grad_var, n_games)
+						else:
+							tb_tracker.track("grad_l2",         grad_l2, n_games)
+							tb_tracker.track("grad_max",        grad_max, n_games)
+							tb_tracker.track("grad_var",        grad_var, n_games)
+				n_batches += 1
+				if capture is not None:
+					capture.step()
+				if n_batches % PROFILE_INTERVAL == 0:
+					profiler.write(writer, n_games)
 
-				states_v, actions_t, vals_ref_v = unpack_batch(batch, net, device=device)
-				batch.clear()
-
-				optimizer.zero_grad()
-				logits_v, value_v = net(states_v)
-				loss_value_v = F.mse_loss(value_v.squeeze(-1), vals_ref_v)
-
-				log_prob_v = F.log_softmax(logits_v, dim=1)
-				adv_v = vals_ref_v - value_v.detach()
-				log_prob_actions_v = adv_v * log_prob_v[range(BATCH_SIZE), actions_t]
-				loss_policy_v = -log_prob_actions_v.mean()
-
-				prob_v = F.softmax(logits_v, dim=1)
-				entropy_loss_v = ENTROPY_BETA * (prob_v * log_prob_v).sum(dim=1).mean()
-
-				# calculate policy gradients only
-				loss_policy_v.backward(retain_graph=True)
-				grads = np.concatenate([p.grad.data.cpu().numpy().flatten()
-										for p in net.parameters()
-										if p.grad is not None])
-
-				# apply entropy and value gradients
-				loss_v = entropy_loss_v + loss_value_v
-				loss_v.backward()
-				nn_utils.clip_grad_norm_(net.parameters(), CLIP_GRAD)
-				optimizer.step()
-				# get full loss
-				loss_v += loss_policy_v
-					
 				tb_tracker.track("advantage",       adv_v, n_games)
 				tb_tracker.track("values",          value_v, n_games)
 				tb_tracker.track("batch_rewards",   vals_ref_v, n_games)
@@ -200,6 +846,12 @@ if __name__ == "__main__":
 				tb_tracker.track("loss_policy",     loss_policy_v, n_games)
 				tb_tracker.track("loss_value",      loss_value_v, n_games)
 				tb_tracker.track("loss_total",      loss_v, n_games)
-				tb_tracker.track("grad_l2",         np.sqrt(np.mean(np.square(grads))), n_games)
-				tb_tracker.track("grad_max",        np.max(np.abs(grads)), n_games)
-				tb_tracker.track("grad_var",        np.var(grads), n_games)
+
+		checkpointer.save(train_state(net, optimizer, tracker, curriculum, n_games, step_idx, n_batches), n_games)
+	checkpointer.close()
+
+	if curriculum is not None:
+		env = curriculum.source.env
+	env.close()
+	if prefetcher is not None:
+		prefetcher.close()